@@ -0,0 +1,93 @@
+import bisect
+import math
+import random
+
+# Message inter-arrival gaps for one node, drawn ahead in blocks.
+#
+# The gaps have the distribution of sim.poisson_usecs(): the mean is halved
+# until it is at most 64, a Poisson variate with that smaller mean is drawn
+# and scaled back up by the same power of two. poisson_usecs() does that with
+# one random.random() call per unit of the variate; here a block of variates
+# is drawn at once, one random() each, inverted through a table of the
+# Poisson CDF.
+#
+# Every node has its own random.Random, seeded from the node's arrivals
+# stream (see rngstreams.py), so a node's gaps depend only on the simulation
+# seed, on any machine. NumPy is deliberately not used even when installed:
+# its generators would give other gaps for the same seed.
+
+DEFAULT_BLOCK = 1024
+
+cdf_tables = {} # lam -> cumulative Poisson probabilities for 0, 1, ...
+
+
+def split_mean(mean_usecs):
+  # (lam, mult) as used by poisson_usecs()
+  lam = mean_usecs
+  mult = 1.0
+
+  while (lam > 64.0):
+    lam = lam / 2.0
+    mult = mult * 2.0
+
+  return (lam, mult)
+
+
+def poisson_cdf(lam):
+  table = cdf_tables.get(lam)
+
+  if table is None:
+    # up to where the remaining tail is below a double's resolution
+    table = []
+    pmf = math.exp(-lam)
+    total = 0.0
+    k = 0
+    while True:
+      total = total + pmf
+      table.append(total)
+      k = k + 1
+      if k > lam and (1.0 - total < 1e-17 or pmf < 1e-300):
+        break
+      pmf = pmf * lam / k
+
+    cdf_tables[lam] = table
+
+  return table
+
+
+class PoissonArrivals:
+  def __init__(self, mean_usecs, seed, block=DEFAULT_BLOCK):
+    self.mean_usecs = mean_usecs
+    self.lam, self.mult = split_mean(mean_usecs)
+    self.block = block
+    self.gaps = []
+    self.index = 0
+
+    self.rng = random.Random(seed)
+    self.cdf = poisson_cdf(self.lam)
+
+  def set_mean(self, mean_usecs):
+    # carries on along the same stream; gaps drawn at the old rate are
+    # dropped, and no uniform is ever used twice
+    self.mean_usecs = mean_usecs
+    self.lam, self.mult = split_mean(mean_usecs)
+    self.cdf = poisson_cdf(self.lam)
+    self.gaps = []
+    self.index = 0
+
+  def refill(self):
+    draw = self.rng.random
+    cdf = self.cdf
+    last = len(cdf) - 1
+    mult = self.mult
+    self.gaps = [math.floor(min(bisect.bisect_right(cdf, draw()), last) * mult)
+      for i in range(self.block)]
+    self.index = 0
+
+  def next(self):
+    if self.index == len(self.gaps):
+      self.refill()
+
+    gap = self.gaps[self.index]
+    self.index = self.index + 1
+    return gap
@@ -0,0 +1,337 @@
+import gc
+import json
+import time
+import random
+import argparse
+import platform
+
+import sim
+import topogen
+import checksums
+from defs import Event
+
+# Benchmarks of the simulator engine, saved as JSON baselines so a change can
+# be checked for regressions:
+#
+#   python bench.py run -o before.json
+#   ... change the engine ...
+#   python bench.py run -o after.json
+#   python bench.py compare before.json after.json --threshold 0.1
+#
+# Every result is a rate, so higher is better:
+#
+#   events/MODULE/N          events per second raised to nodes by
+#                            process_next_event(); queue entries that raise
+#                            nothing, such as those of stopped timers, are
+#                            not counted
+#   timers/MODULE/N          start_timer() and stop_timer() pairs per second
+#   write_physical/MODULE/N  frames per second handed to write_physical() on
+#                            an idle link
+#   checksum/LENGTH          bytes per second through checksum_ccitt()
+#
+# for each protocol module and N-node topology. The topologies are N / 2
+# separate pairs of hosts, as in PIGGYBACK, since most protocol modules
+# expect one link per node; modules that use several links can be given any
+# topogen.py shape with --shape. benchpairs.py runs on any number of pairs,
+# stopandwait only on 2 nodes, so it is left out of larger sizes (see
+# MODULE_MAX_NODES). Each benchmark is run --repeat times with the garbage
+# collector off and the best rate kept, so other load on the machine mostly
+# shows up as fewer fast runs rather than slower results.
+#
+# compare lists every result of both files and exits with status 1 when any
+# rate has fallen by more than the threshold (a fraction of the old rate).
+
+DEFAULT_SIZES = (2, 50, 500)
+DEFAULT_MODULES = ('benchpairs', 'stopandwait')
+MODULE_MAX_NODES = {'stopandwait': 2}
+DEFAULT_EVENTS = 50000
+DEFAULT_OPERATIONS = 50000
+DEFAULT_REPEAT = 5
+DEFAULT_THRESHOLD = 0.1
+CHECKSUM_LENGTHS = (64, 1024)
+
+# links busy enough that frames queue, corrupt and get retransmitted
+LINK_SETTINGS = {
+  'messagerate': '100ms',
+  'bandwidth': '1Mbps',
+  'propagationdelay': '10ms',
+  'probframecorrupt': 3
+}
+
+UNITS = {
+  'events': 'events/s',
+  'timers': 'pairs/s',
+  'write_physical': 'frames/s',
+  'checksum': 'bytes/s'
+}
+
+
+def pairs_topology(nodes, module):
+  if nodes < 2 or nodes % 2:
+    raise RuntimeError('a topology of pairs needs an even number of nodes, not {}'.format(
+      nodes))
+
+  hosts = []
+  for i in range(0, nodes, 2):
+    hosts.append({'name': 'node{}'.format(i),
+      'links': [{'to': 'node{}'.format(i + 1)}]})
+    hosts.append({'name': 'node{}'.format(i + 1)})
+
+  topology = {'module': module, 'hosts': hosts}
+  topology.update(LINK_SETTINGS)
+  return topology
+
+
+def bench_topology(shape, nodes, module, seed):
+  if shape == 'pairs':
+    return pairs_topology(nodes, module)
+
+  topology = topogen.generate(shape, nodes, seed=seed, module=module)
+  topology.update(LINK_SETTINGS)
+  return topology
+
+
+def booted_simulator(topology, seed):
+  simulator = sim.Simulator(topology, silent_nodes=True, seed=seed)
+  simulator.boot_nodes()
+  return simulator
+
+
+def bench_events(topology, seed, events):
+  simulator = booted_simulator(topology, seed)
+  step = simulator.process_next_event
+
+  # past the start, where every node is still sending its first frame
+  for i in range(events // 10):
+    step()
+
+  first = simulator.events_raised
+  start = time.perf_counter()
+  while simulator.events_raised - first < events and step():
+    pass
+  elapsed = time.perf_counter() - start
+
+  raised = simulator.events_raised - first
+  simulator.close()
+  return raised / elapsed
+
+
+def bench_timers(topology, seed, operations):
+  simulator = booted_simulator(topology, seed)
+  simulator.current_index = 0 # as if called by node 0's protocol
+  start_timer = simulator.start_timer
+  stop_timer = simulator.stop_timer
+
+  start = time.perf_counter()
+  for i in range(operations):
+    stop_timer(start_timer(Event.TIMER1, 1000 + i))
+  elapsed = time.perf_counter() - start
+
+  simulator.close()
+  return operations / elapsed
+
+
+def bench_write_physical(topology, seed, operations):
+  simulator = booted_simulator(topology, seed)
+  simulator.current_index = 0
+  write_physical = simulator.write_physical
+  frame = random.Random(seed).randbytes(64)
+
+  # each frame is written once the one before has left, so none queue
+  linkinfo = simulator.nodes[0].linkinfos[1]
+  gap = len(frame) * 8 * sim.TIME_SUFFIX_TO_USEC['s'] // linkinfo.bandwidth + 1
+  now = simulator.current_time_usec
+
+  start = time.perf_counter()
+  for i in range(operations):
+    simulator.current_time_usec = now
+    write_physical(1, frame)
+    now = now + gap
+  elapsed = time.perf_counter() - start
+
+  simulator.close()
+  return operations / elapsed
+
+
+def bench_checksum(length, seed, operations):
+  data = random.Random(seed).randbytes(length)
+  checksum = checksums.checksum_ccitt
+  count = max(1, operations // length)
+
+  start = time.perf_counter()
+  for i in range(count):
+    checksum(data)
+  elapsed = time.perf_counter() - start
+
+  return count * length / elapsed
+
+
+def best_of(repeat, measure, *args):
+  # as timeit does, without the collector's pauses landing in some runs only
+  rates = []
+  for i in range(repeat):
+    gc.collect()
+    gc.disable()
+    try:
+      rates.append(measure(*args))
+    finally:
+      gc.enable()
+  return max(rates)
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, modules=DEFAULT_MODULES, shape='pairs',
+    events=DEFAULT_EVENTS, operations=DEFAULT_OPERATIONS,
+    repeat=DEFAULT_REPEAT, seed=1, progress=None):
+  # name -> rate, for every benchmark
+  results = {}
+
+  def record(name, rate):
+    results[name] = rate
+    if progress:
+      progress('{:40} {:14.1f} {}'.format(name, rate, UNITS[name.split('/')[0]]))
+
+  for module in modules:
+    for size in sizes:
+      if size > MODULE_MAX_NODES.get(module, size):
+        continue
+
+      topology = bench_topology(shape, size, module, seed)
+      suffix = '/{}/{}'.format(module, size)
+
+      record('events' + suffix, best_of(repeat, bench_events, topology,
+        seed, events))
+      record('timers' + suffix, best_of(repeat, bench_timers, topology,
+        seed, operations))
+      record('write_physical' + suffix, best_of(repeat, bench_write_physical,
+        topology, seed, operations))
+
+  for length in CHECKSUM_LENGTHS:
+    record('checksum/{}'.format(length), best_of(repeat, bench_checksum,
+      length, seed, operations * 64))
+
+  return results
+
+
+def save_baseline(path, results, settings):
+  baseline = {
+    'python': platform.python_version(),
+    'implementation': platform.python_implementation(),
+    'machine': platform.machine(),
+    'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'settings': settings,
+    'results': dict([(name, {'rate': rate, 'unit': UNITS[name.split('/')[0]]})
+      for name, rate in results.items()])
+  }
+
+  with open(path, 'w') as fout:
+    json.dump(baseline, fout, indent=2)
+    fout.write('\n')
+
+
+def load_baseline(path):
+  try:
+    with open(path) as fin:
+      baseline = json.load(fin)
+    return dict([(name, result['rate'])
+      for name, result in baseline['results'].items()])
+  except (OSError, ValueError, KeyError, TypeError) as e:
+    raise RuntimeError('cannot read benchmark baseline {}: {}'.format(path, e))
+
+
+def compare_baselines(old, new, threshold=DEFAULT_THRESHOLD):
+  # (name, old rate, new rate, relative change, verdict) for every name in
+  # either; verdict is 'regression', 'improved', 'ok', 'new' or 'missing'
+  rows = []
+
+  for name in sorted(set(old) | set(new)):
+    if not name in new:
+      rows.append((name, old[name], None, None, 'missing'))
+      continue
+    if not name in old:
+      rows.append((name, None, new[name], None, 'new'))
+      continue
+
+    change = new[name] / old[name] - 1
+    verdict = 'ok'
+    if change < -threshold:
+      verdict = 'regression'
+    elif change > threshold:
+      verdict = 'improved'
+
+    rows.append((name, old[name], new[name], change, verdict))
+
+  return rows
+
+
+def format_rate(rate):
+  return '-' if rate is None else '{:.1f}'.format(rate)
+
+
+def print_comparison(rows):
+  print('{:40} {:>14} {:>14} {:>8}'.format('benchmark', 'old', 'new', 'change'))
+  for name, old, new, change, verdict in rows:
+    change = '-' if change is None else '{:+.1%}'.format(change)
+    print('{:40} {:>14} {:>14} {:>8}  {}'.format(name, format_rate(old),
+      format_rate(new), change, verdict))
+
+
+def parse_list(s):
+  return [v.strip() for v in s.split(',') if v.strip()]
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog='Network Simulator Benchmarks')
+  commands = parser.add_subparsers(dest='command', required=True)
+
+  run_parser = commands.add_parser('run')
+  run_parser.add_argument('-o', '--output')
+  run_parser.add_argument('-n', '--sizes', type=parse_list,
+    default=[str(size) for size in DEFAULT_SIZES])
+  run_parser.add_argument('-m', '--modules', type=parse_list,
+    default=list(DEFAULT_MODULES))
+  run_parser.add_argument('--shape', default='pairs',
+    choices=('pairs',) + topogen.SHAPES)
+  run_parser.add_argument('--events', type=int, default=DEFAULT_EVENTS)
+  run_parser.add_argument('--operations', type=int, default=DEFAULT_OPERATIONS)
+  run_parser.add_argument('-r', '--repeat', type=int, default=DEFAULT_REPEAT)
+  run_parser.add_argument('-S', '--seed', type=int, default=1)
+
+  compare_parser = commands.add_parser('compare')
+  compare_parser.add_argument('old')
+  compare_parser.add_argument('new')
+  compare_parser.add_argument('-t', '--threshold', type=float,
+    default=DEFAULT_THRESHOLD)
+
+  args = parser.parse_args(argv)
+
+  try:
+    if args.command == 'run':
+      try:
+        sizes = [int(size) for size in args.sizes]
+      except ValueError:
+        raise RuntimeError('sizes must be numbers of nodes')
+
+      settings = {'sizes': sizes, 'modules': args.modules,
+        'shape': args.shape, 'events': args.events,
+        'operations': args.operations, 'repeat': args.repeat,
+        'seed': args.seed}
+
+      results = run_benchmarks(sizes, args.modules, args.shape, args.events,
+        args.operations, args.repeat, args.seed, progress=print)
+
+      if args.output:
+        save_baseline(args.output, results, settings)
+    else:
+      rows = compare_baselines(load_baseline(args.old), load_baseline(args.new),
+        args.threshold)
+      print_comparison(rows)
+
+      if any([row[4] == 'regression' for row in rows]):
+        exit(1)
+  except RuntimeError as e:
+    print(e)
+    exit(1)
+
+
+if __name__ == '__main__':
+  main()
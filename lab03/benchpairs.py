@@ -0,0 +1,115 @@
+import struct
+
+from defs import Event, LogLevel
+import checksums
+
+# A stop-and-wait data link protocol for topologies of separate pairs of
+# hosts, such as the ones bench.py builds: node 2k and node 2k + 1 share
+# link 1 and only send messages to each other. Frames carry a CCITT checksum
+# and are retransmitted on a timer until acknowledged, so a run exercises
+# the same engine paths as stopandwait at any number of nodes.
+
+nodeinfo = None
+linkinfo = []
+
+
+def enable_application(nodenumber=None):
+    pass
+
+
+def disable_application(nodenumber=None):
+    pass
+
+
+def start_timer(event, usecs, data=None):
+    return 0  # returns a timerid
+
+
+def stop_timer(timerid):
+    pass
+
+
+def set_handler(event, callback):
+    pass
+
+
+def write_physical(linknum, framebytes):
+    return True  # iff write successful (link existed)
+
+
+def write_application(message):
+    return True  # iff message accepted
+
+
+def log(level, message, *args):
+    pass  # message.format(*args) is only done if level is being output
+
+
+# Protocol-specific code
+
+DLL_DATA = 0
+DLL_ACK = 1
+
+# kind, seq, checksum of the whole frame (taken as 0 while computing it)
+HEADER = struct.Struct('!HHi')
+
+
+def make_frame(kind, seq, msg):
+    checksum = checksums.checksum_ccitt(HEADER.pack(kind, seq, 0) + msg)
+    return HEADER.pack(kind, seq, checksum) + msg
+
+
+class Node:
+    def __init__(self):
+        self.peer = nodeinfo.nodenumber ^ 1
+        self.lastmsg = None
+        self.data_timer = None
+        self.ackexpected = 0
+        self.frameexpected = 0
+
+    def transmit_data(self):
+        packed = make_frame(DLL_DATA, self.ackexpected, self.lastmsg)
+        write_physical(1, packed)
+
+        timeout = (len(packed) * (8000000 // linkinfo[1].bandwidth)
+                   + linkinfo[1].propagationdelay)
+        self.data_timer = start_timer(Event.TIMER1, 3 * timeout, None)
+
+    def application_ready(self, destination: int, message: bytes):
+        self.lastmsg = message
+        disable_application()
+        self.transmit_data()
+
+    def physical_ready(self, linkno: int, framebytes: bytes):
+        if len(framebytes) < HEADER.size:
+            return
+
+        kind, seq, checksum = HEADER.unpack_from(framebytes)
+        msg = framebytes[HEADER.size:]
+
+        if checksum != checksums.checksum_ccitt(HEADER.pack(kind, seq, 0) + msg):
+            log(LogLevel.INFO, 'BAD checksum - frame ignored')
+            return
+
+        if kind == DLL_DATA:
+            if seq == self.frameexpected:
+                write_application(msg)
+                self.frameexpected = 1 - self.frameexpected
+            write_physical(1, make_frame(DLL_ACK, seq, bytes()))
+
+        elif kind == DLL_ACK and seq == self.ackexpected:
+            stop_timer(self.data_timer)
+            self.ackexpected = 1 - self.ackexpected
+            enable_application(self.peer)
+
+    def data_timeout(self):
+        log(LogLevel.INFO, 'Data timeout, retransmitting seq={}', self.ackexpected)
+        self.transmit_data()
+
+    # Node init
+    def reboot_node(self):
+        set_handler(Event.APPLICATIONREADY, self.application_ready)
+        set_handler(Event.PHYSICALREADY, self.physical_ready)
+        set_handler(Event.TIMER1, self.data_timeout)
+
+        enable_application(self.peer)
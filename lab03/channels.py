@@ -0,0 +1,193 @@
+import random
+
+# Channel models deciding the fate of every frame sent on one direction of a
+# link. fate(length) returns (lost, offset) where offset is None or the
+# position of the two bytes to corrupt (see Simulator.corrupt_frame).
+#
+# LegacyChannel makes the original 1 in 2**n loss and corruption draws,
+# reading the linkinfo's probframeloss and probframecorrupt each time, from
+# the link's own random.Random or, to reproduce old runs, the random module.
+# The other models take arbitrary probabilities and consume uniform variates
+# drawn ahead in blocks from a random.Random, so the same seed makes the
+# same decisions on every machine:
+#
+#   BernoulliChannel  independent loss with probability lossprob; a frame
+#                     that gets through is corrupted with probability
+#                     corruptprob, or because one of its bits is hit at
+#                     biterrorrate
+#   GilbertElliott    a two state Markov channel for bursty errors. Each
+#                     state has its own loss and corruption as above; after
+#                     every frame the channel moves from good to bad with
+#                     probability p and from bad to good with probability r
+#
+# build_channel() makes a model from the topology keys "lossprob",
+# "corruptprob", "biterrorrate" and "channel", e.g.
+#
+#   "channel": {"model": "gilbert-elliott", "p": 0.01, "r": 0.25,
+#               "bad": {"lossprob": 0.5}, "good": {"biterrorrate": 1e-6}}
+
+DEFAULT_BLOCK = 4096
+
+# A seed may be given as a function returning it (see
+# RandomStreams.deferred_seed()); a channel's random.Random is only made on
+# its first draw, so building the channels of a large topology costs little.
+
+CHANNEL_KEYS = ('lossprob', 'corruptprob', 'biterrorrate', 'channel')
+
+
+def stream_seed(seed):
+  return seed() if callable(seed) else seed
+
+
+class UniformStream:
+  def __init__(self, seed, block=DEFAULT_BLOCK):
+    self.block = block
+    self.values = []
+    self.index = 0
+    self.seed = seed
+    self.rng = None # made on the first refill
+
+  def refill(self):
+    if self.rng is None:
+      self.rng = random.Random(stream_seed(self.seed))
+
+    draw = self.rng.random
+    self.values = [draw() for i in range(self.block)]
+    self.index = 0
+
+  def next(self):
+    if self.index == len(self.values):
+      self.refill()
+
+    value = self.values[self.index]
+    self.index = self.index + 1
+    return value
+
+
+class LegacyChannel:
+  # rng None draws from a random.Random of the link's own, seeded from seed
+  def __init__(self, linkinfo, rng=random, seed=None):
+    self.linkinfo = linkinfo
+    self.rng = rng
+    self.seed = seed
+
+  def fate(self, length):
+    rng = self.rng
+    if rng is None:
+      rng = self.rng = random.Random(stream_seed(self.seed))
+
+    probloss = self.linkinfo.probframeloss
+    if probloss and rng.randrange(0, probloss) == 0:
+      return (True, None)
+
+    probcorrupt = self.linkinfo.probframecorrupt
+    if (probcorrupt > 0 and rng.randrange(0, probcorrupt) == 0):
+      return (False, rng.randrange(0, length - 2))
+
+    return (False, None)
+
+
+class ErrorRates:
+  # loss and corruption probabilities of a channel, or of one of its states
+  def __init__(self, lossprob=0.0, corruptprob=0.0, biterrorrate=0.0):
+    for name, value in (('lossprob', lossprob), ('corruptprob', corruptprob),
+        ('biterrorrate', biterrorrate)):
+      if not 0.0 <= value <= 1.0:
+        raise RuntimeError('{}={} is not a probability'.format(name, value))
+
+    self.lossprob = lossprob
+    self.corruptprob = corruptprob
+    self.biterrorrate = biterrorrate
+    self.intact = {} # length -> probability a frame of it is not corrupted
+
+  def corruption(self, length):
+    intact = self.intact.get(length)
+
+    if intact is None:
+      intact = (1.0 - self.corruptprob) * (1.0 - self.biterrorrate) ** (8 * length)
+      self.intact[length] = intact
+
+    return 1.0 - intact
+
+  def fate(self, uniforms, length):
+    if self.lossprob and uniforms.next() < self.lossprob:
+      return (True, None)
+
+    if (self.corruptprob or self.biterrorrate) and length > 2 \
+        and uniforms.next() < self.corruption(length):
+      return (False, int(uniforms.next() * (length - 2)))
+
+    return (False, None)
+
+
+class BernoulliChannel:
+  def __init__(self, rates, seed):
+    self.rates = rates
+    self.uniforms = UniformStream(seed)
+
+  def fate(self, length):
+    return self.rates.fate(self.uniforms, length)
+
+
+class GilbertElliott:
+  def __init__(self, p, r, good, bad, seed):
+    for name, value in (('p', p), ('r', r)):
+      if not 0.0 <= value <= 1.0:
+        raise RuntimeError('gilbert-elliott {}={} is not a probability'.format(
+          name, value))
+
+    self.p = p
+    self.r = r
+    self.good = good
+    self.bad = bad
+    self.in_bad = False
+    self.uniforms = UniformStream(seed)
+
+  def fate(self, length):
+    if self.in_bad:
+      fate = self.bad.fate(self.uniforms, length)
+      if self.uniforms.next() < self.r:
+        self.in_bad = False
+    else:
+      fate = self.good.fate(self.uniforms, length)
+      if self.uniforms.next() < self.p:
+        self.in_bad = True
+
+    return fate
+
+
+def error_rates(spec, what):
+  try:
+    return ErrorRates(float(spec.get('lossprob', 0.0)),
+      float(spec.get('corruptprob', 0.0)), float(spec.get('biterrorrate', 0.0)))
+  except (TypeError, ValueError):
+    raise RuntimeError('failed to set the error rates of {}'.format(what))
+
+
+def build_channel(spec, linkinfo, seed, what, rng=random):
+  # spec holds the CHANNEL_KEYS that apply to the link; without any of them
+  # the link keeps the legacy power of two probabilities, drawn from rng or,
+  # if rng is None, from a stream of its own seeded from seed
+  if not spec:
+    return LegacyChannel(linkinfo, rng, seed)
+
+  model = spec.get('channel')
+
+  if model is None:
+    return BernoulliChannel(error_rates(spec, what), seed)
+
+  name = model.get('model', 'gilbert-elliott')
+  if name == 'bernoulli':
+    return BernoulliChannel(error_rates(model, what), seed)
+
+  if name != 'gilbert-elliott':
+    raise RuntimeError('unknown channel model {} for {}'.format(name, what))
+
+  try:
+    p = float(model['p'])
+    r = float(model['r'])
+  except (KeyError, TypeError, ValueError):
+    raise RuntimeError('gilbert-elliott channel for {} needs p and r'.format(what))
+
+  return GilbertElliott(p, r, error_rates(model.get('good', {}), what),
+    error_rates(model.get('bad', {}), what), seed)
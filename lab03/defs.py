@@ -1,4 +1,4 @@
-from enum import Enum
+from enum import Enum, IntEnum
 
 class Event(Enum):
   NULL = 0
@@ -15,15 +15,33 @@ class Event(Enum):
   TIMER5 = 11
   TIMER6 = 12
 
+class LogLevel(IntEnum):
+  DEBUG = 10
+  INFO = 20
+  WARNING = 30
+  ERROR = 40
+
 class LinkType(Enum):
   LOOPBACK = 0
   WAN = 1
 
+class QueuePolicy(Enum):
+  DROPTAIL = 0 # a full queue refuses new frames
+  DROPHEAD = 1 # a full queue discards its oldest frame to make room
+
 class LinkInfo:
-  def __init__(self, linktype, bandwidth, propagationdelay, probframeloss, probframecorrupt):
+  __slots__ = ('linktype', 'linkup', 'bandwidth', 'propagationdelay',
+    'probframeloss', 'probframecorrupt', 'txqueuelength', 'txqueuepolicy',
+    'channel')
+
+  def __init__(self, linktype, bandwidth, propagationdelay, probframeloss, probframecorrupt,
+      txqueuelength=None, txqueuepolicy=QueuePolicy.DROPTAIL):
     self.linktype = linktype
     self.linkup = True
     self.bandwidth = bandwidth # in bits per second
     self.propagationdelay = propagationdelay # in usecs, for WAN
     self.probframeloss = probframeloss
     self.probframecorrupt = probframecorrupt
+    self.txqueuelength = txqueuelength # frames waiting to be sent, None for no limit
+    self.txqueuepolicy = txqueuepolicy
+    self.channel = None # decides the fate of each frame, see channels.py
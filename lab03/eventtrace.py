@@ -0,0 +1,104 @@
+import mmap
+import struct
+from enum import IntEnum
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# Binary trace of every engine event in a simulator run.
+#
+# A trace file is an 8 byte magic string followed by fixed-width little-endian
+# records with no padding:
+#
+#   time   int64   simulation time in usecs
+#   kind   uint8   TraceKind
+#   flags  uint8   TRACE_* bits
+#   port   int16   link number, or Event value for timer records
+#   node   int32   node the event happened at
+#   peer   int32   other node involved (message destination, frame sender)
+#   id     int64   message number, frame number or timer id
+#   value  int64   bytes for messages and frames, usecs for timers and
+#                  delivery latency for write_application
+#
+# A frame dropped by a full transmit queue is a WRITE_PHYSICAL record with
+# TRACE_DROPPED set, at the time it was dropped.
+#
+# open_trace() maps a file as a NumPy record array (or, without NumPy, iterates
+# over its records as tuples) so long traces can be analysed without re-running
+# the simulation.
+
+TRACE_MAGIC = b'NSTRACE1'
+TRACE_RECORD = struct.Struct('<qBBhiiqq')
+
+TRACE_FIELDS = ('time', 'kind', 'flags', 'port', 'node', 'peer', 'id', 'value')
+
+if numpy is not None:
+  TRACE_DTYPE = numpy.dtype([('time', '<i8'), ('kind', 'u1'), ('flags', 'u1'),
+    ('port', '<i2'), ('node', '<i4'), ('peer', '<i4'), ('id', '<i8'),
+    ('value', '<i8')])
+else:
+  TRACE_DTYPE = None
+
+TRACE_LOST = 1
+TRACE_CORRUPTED = 2
+TRACE_REJECTED = 4
+TRACE_DROPPED = 8
+
+
+class TraceKind(IntEnum):
+  APPLICATION_MESSAGE = 0
+  WRITE_PHYSICAL = 1
+  FRAME_DELIVERY = 2
+  TIMER_START = 3
+  TIMER_FIRE = 4
+  TIMER_CANCEL = 5
+  WRITE_APPLICATION = 6
+
+
+class TraceWriter:
+  def __init__(self, path, buffer_records=1 << 15):
+    self.file = open(path, 'wb')
+    self.file.write(TRACE_MAGIC)
+
+    self.buffer = bytearray(TRACE_RECORD.size * buffer_records)
+    self.offset = 0
+    self.records = 0
+    self.pack_into = TRACE_RECORD.pack_into
+
+  def record(self, time, kind, flags, port, node, peer, id, value):
+    self.pack_into(self.buffer, self.offset, time, kind, flags, port, node,
+      peer, id, value)
+    self.offset = self.offset + TRACE_RECORD.size
+    self.records = self.records + 1
+
+    if self.offset == len(self.buffer):
+      self.flush()
+
+  def flush(self):
+    if self.offset:
+      self.file.write(memoryview(self.buffer)[:self.offset])
+      self.offset = 0
+    self.file.flush()
+
+  def close(self):
+    if self.file:
+      self.flush()
+      self.file.close()
+      self.file = None
+
+
+def open_trace(path):
+  with open(path, 'rb') as fin:
+    if fin.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+      raise RuntimeError('{} is not a simulator trace'.format(path))
+
+  if numpy is not None:
+    return numpy.memmap(path, dtype=TRACE_DTYPE, mode='r',
+      offset=len(TRACE_MAGIC))
+
+  with open(path, 'rb') as fin:
+    data = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+  return TRACE_RECORD.iter_unpack(memoryview(data)[len(TRACE_MAGIC):])
@@ -0,0 +1,166 @@
+import csv
+from array import array
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# Metrics collected by the simulator at every stats period. Each interval is
+# one row of preallocated array-backed columns holding how much each counter
+# grew during it; rates are only worked out when the metrics are saved.
+# Delivery latencies go into a log-bucketed histogram with 8 sub-buckets per
+# power of two (within 12.5%), from which p50, p99 and p999 are read.
+
+INTERVAL_COLUMNS = ('time', 'events_raised', 'messages_generated',
+  'messages_delivered', 'total_delivery_time', 'frames_transmitted',
+  'frames_received', 'bytes_received_physical', 'bytes_received_application')
+
+SUB_BUCKET_BITS = 3
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+HISTOGRAM_BUCKETS = (64 - SUB_BUCKET_BITS) * SUB_BUCKETS + 2 * SUB_BUCKETS
+
+
+def bucket_range(bucket):
+  # [low, high) of the values counted in bucket
+  if bucket < 2 * SUB_BUCKETS:
+    return (bucket, bucket + 1)
+  shift = (bucket >> SUB_BUCKET_BITS) - 1
+  low = (bucket - (shift << SUB_BUCKET_BITS)) << shift
+  return (low, low + (1 << shift))
+
+
+def check_metrics_path(path):
+  # so a run fails at the start rather than once it has finished
+  if path and path.endswith('.npz') and numpy is None:
+    raise RuntimeError('saving metrics as {} needs numpy'.format(path))
+
+
+class LatencyHistogram:
+  def __init__(self):
+    self.counts = array('q', bytes(8 * HISTOGRAM_BUCKETS))
+    self.count = 0
+    self.maximum = 0
+
+  def record(self, value):
+    if value < 2 * SUB_BUCKETS:
+      self.counts[value] += 1
+    else:
+      shift = value.bit_length() - SUB_BUCKET_BITS - 1
+      self.counts[(shift << SUB_BUCKET_BITS) + (value >> shift)] += 1
+    self.count = self.count + 1
+    if value > self.maximum:
+      self.maximum = value
+
+  def merge(self, counts, count, maximum):
+    # add in another histogram's counts, e.g. from another process
+    for bucket, n in enumerate(counts):
+      if n:
+        self.counts[bucket] += n
+    self.count = self.count + count
+    if maximum > self.maximum:
+      self.maximum = maximum
+
+  def percentile(self, p):
+    # midpoint of the bucket holding the p-th percentile, never above the
+    # largest value seen
+    if not self.count:
+      return 0
+
+    rank = p * self.count / 100
+    seen = 0
+    for bucket in range(HISTOGRAM_BUCKETS):
+      seen = seen + self.counts[bucket]
+      if seen >= rank and seen > 0:
+        low, high = bucket_range(bucket)
+        return min((low + high - 1) // 2, self.maximum)
+
+    return self.maximum
+
+  def percentiles(self):
+    return {
+      'delivery_p50': self.percentile(50),
+      'delivery_p99': self.percentile(99),
+      'delivery_p999': self.percentile(99.9)
+    }
+
+
+class MetricsStore:
+  def __init__(self, capacity=1024):
+    self.columns = dict([(name, array('q', bytes(8 * capacity)))
+      for name in INTERVAL_COLUMNS])
+    self.capacity = capacity
+    self.intervals = 0
+    self.last = [0] * len(INTERVAL_COLUMNS)
+    self.latency = LatencyHistogram()
+
+  def reserve(self, capacity):
+    if capacity > self.capacity:
+      extra = bytes(8 * (capacity - self.capacity))
+      for column in self.columns.values():
+        column.frombytes(extra)
+      self.capacity = capacity
+
+  def record_interval(self, simulator):
+    now = [simulator.current_time_usec, simulator.events_raised,
+      simulator.messages_generated, simulator.messages_delivered,
+      simulator.total_delivery_time, simulator.frames_transmitted,
+      simulator.frames_received, simulator.bytes_received_physical,
+      simulator.bytes_received_application]
+
+    if now[0] == self.last[0] and self.intervals:
+      return
+
+    if self.intervals == self.capacity:
+      self.reserve(2 * self.capacity)
+
+    row = self.intervals
+    for name, value, last in zip(INTERVAL_COLUMNS, now, self.last):
+      self.columns[name][row] = value - last
+
+    self.columns['time'][row] = now[0] # interval end, not its length
+    self.last = now
+    self.intervals = row + 1
+
+  def column(self, name):
+    return self.columns[name][:self.intervals]
+
+  def rows(self):
+    # per interval: end time, length, the counter deltas and derived rates
+    start = 0
+    for i in range(self.intervals):
+      end = self.columns['time'][i]
+      length = end - start
+      seconds = length / 1000000 if length else 0
+      delivered = self.columns['messages_delivered'][i]
+      physical = self.columns['bytes_received_physical'][i]
+
+      yield ([end, length]
+        + [self.columns[name][i] for name in INTERVAL_COLUMNS[1:]]
+        + [delivered / seconds if seconds else 0,
+           self.columns['total_delivery_time'][i] // delivered if delivered else 0,
+           self.columns['bytes_received_application'][i] / physical if physical else 1])
+      start = end
+
+  def percentiles(self):
+    return self.latency.percentiles()
+
+  def save(self, path):
+    if path.endswith('.npz'):
+      check_metrics_path(path)
+
+      columns = dict([(name, numpy.frombuffer(self.column(name), dtype='<i8'))
+        for name in INTERVAL_COLUMNS])
+      numpy.savez(path, latency_histogram=numpy.frombuffer(self.latency.counts,
+        dtype='<i8'), **columns)
+      return
+
+    with open(path, 'w', newline='') as fout:
+      writer = csv.writer(fout, quoting=csv.QUOTE_MINIMAL)
+      writer.writerow(['Interval End (usec)', 'Interval (usec)',
+        'Events Raised', 'Messages Generated', 'Messages Delivered',
+        'Total Delivery Time (usec)', 'Frames Transmitted', 'Frames Received',
+        'Bytes Received (Physical)', 'Bytes Received (Application)',
+        'Messages Delivered/sec', 'Average Delivery Time (usec)',
+        'Efficiency (AL/PL)'])
+      writer.writerows(self.rows())
@@ -0,0 +1,81 @@
+import queue
+import threading
+
+# Buffered writer for node output. Text is collected in memory and written
+# out in large chunks, either directly or by a background thread so that the
+# event loop never waits on the terminal or the disk.
+
+DEFAULT_BUFFER_SIZE = 1 << 20
+
+
+class BufferedOutput:
+  def __init__(self, output, buffer_size=None, background=False):
+    if buffer_size is None:
+      # someone watching a terminal wants to see lines as they happen
+      buffer_size = 0 if output.isatty() else DEFAULT_BUFFER_SIZE
+
+    self.output = output
+    self.buffer_size = buffer_size
+    self.parts = []
+    self.size = 0
+
+    self.chunks = None
+    self.thread = None
+
+    if background:
+      self.chunks = queue.Queue(maxsize=64)
+      self.thread = threading.Thread(target=self.drain, daemon=True)
+      self.thread.start()
+
+  def write(self, s):
+    self.parts.append(s)
+    self.size = self.size + len(s)
+
+    if self.size >= self.buffer_size:
+      self.write_buffer()
+
+  def write_buffer(self):
+    if not self.parts:
+      return
+
+    chunk = ''.join(self.parts)
+    self.parts = []
+    self.size = 0
+
+    if self.chunks is not None:
+      self.chunks.put(chunk)
+    else:
+      self.output.write(chunk)
+
+  def drain(self):
+    while True:
+      chunk = self.chunks.get()
+
+      if chunk is None:
+        self.chunks.task_done()
+        break
+
+      self.output.write(chunk)
+      self.chunks.task_done()
+
+  def flush(self):
+    self.write_buffer()
+
+    if self.chunks is not None:
+      self.chunks.join()
+
+    self.output.flush()
+
+  def close(self):
+    self.flush()
+
+    if self.thread is not None:
+      self.chunks.put(None)
+      self.thread.join()
+      self.thread = None
+      self.chunks = None
+
+
+def ignore_output(*args, **kwargs):
+  # installed as print() and log() for silent nodes
+  pass
@@ -0,0 +1,571 @@
+import io
+import sys
+import csv
+import heapq
+import secrets
+import multiprocessing
+from collections import deque
+
+import sim
+from defs import LogLevel
+from metrics import LatencyHistogram
+from nodelog import BufferedOutput
+from topology import compile_topology
+
+# Conservative parallel simulation of one topology by several processes.
+#
+# The hosts are split into partitions, either by a "partition" number given
+# on every host or by cutting a breadth-first walk of the topology into runs
+# of equal size. Each partition is simulated by a worker process running a
+# PartitionSimulator: an ordinary Simulator built from the whole topology,
+# in which only that partition's nodes run protocol code. A frame sent to a
+# node of another partition is shipped to the worker simulating it, and so
+# is the note that a message generated for such a node is waiting for it.
+#
+# Workers are kept in step by time windows. No frame crosses between
+# partitions in less than the smallest propagationdelay of the links joining
+# them (the lookahead), so starting from the earliest pending event T every
+# worker can run all of its events before T + lookahead without waiting for
+# the others. The coordinator then hands the frames shipped during the
+# window to their workers, and the next window starts at the earliest event
+# anywhere, skipping stretches where nothing happens.
+#
+# Events at the same time are ordered by their node's own history (see
+# Simulator.schedule()) and every node and link draws from random streams of
+# its own, so each node sees exactly the events it would see in a single
+# process: counters, link and node stats and the stats CSV of a partitioned
+# run match a sequential run with the same seed. Node output is written a
+# window at a time, partition by partition, so every node's lines are in
+# order but the lines of different partitions interleave differently. Timer
+# ids and frame numbers are counted per worker.
+#
+# Runs drawing from the random module (rng='legacy'), random payloads,
+# traces, channel recordings, metrics, steady-state detection and snapshots
+# need the single process Simulator.
+
+ADDITIVE_COUNTERS = ('events_raised', 'messages_generated',
+  'messages_delivered', 'frames_transmitted', 'frames_received',
+  'frames_dropped', 'bytes_received_physical', 'bytes_received_application',
+  'timers_live', 'timers_cancelled')
+
+
+def partition_hosts(topology, partitions):
+  # the partition of every host, in the order of topology['hosts']
+  hosts = topology.get('hosts', [])
+
+  if partitions < 1 or partitions > len(hosts):
+    raise RuntimeError('cannot split {} hosts into {} partitions'.format(
+      len(hosts), partitions))
+
+  given = [host.get('partition') for host in hosts]
+
+  if any([p is not None for p in given]):
+    if any([p is None for p in given]):
+      raise RuntimeError('either every host or no host gives its partition')
+
+    try:
+      assignment = [int(p) for p in given]
+    except (TypeError, ValueError):
+      raise RuntimeError('host partitions must be numbers')
+
+    for p in assignment:
+      if p < 0 or p >= partitions:
+        raise RuntimeError('host partition {} is not between 0 and {}'.format(
+          p, partitions - 1))
+
+    return assignment
+
+  # neighbours end up next to each other in the walk, so mostly in the same
+  # partition
+  neighbours = compile_topology(topology).neighbours()
+
+  order = []
+  seen = [False] * len(hosts)
+
+  for start in range(len(hosts)):
+    if seen[start]:
+      continue
+
+    seen[start] = True
+    walk = deque([start])
+
+    while walk:
+      i = walk.popleft()
+      order.append(i)
+      for j in neighbours[i]:
+        if not seen[j]:
+          seen[j] = True
+          walk.append(j)
+
+  assignment = [0] * len(hosts)
+  for position, i in enumerate(order):
+    assignment[i] = position * partitions // len(hosts)
+
+  return assignment
+
+
+# application_waiting of a node simulated elsewhere: messages generated for
+# it are noted for its own worker instead
+class ForwardedWaiting(dict):
+  def __init__(self, outbox, nodenumber):
+    dict.__init__(self)
+    self.outbox = outbox
+    self.nodenumber = nodenumber
+
+  def __setitem__(self, key, time):
+    self.outbox.append((self.nodenumber, key, time))
+
+
+# The sending side of a link direction into another partition. Its frames
+# are delivered by the receiving worker, so the event keys of the deliveries
+# are kept here to settle in_flight and frames_delivered at the point the
+# sequential engine would have delivered them.
+class RemoteLink:
+  __slots__ = ('partition', 'linkno', 'outbox', 'pending')
+
+  def __init__(self, partition, linkno, outbox):
+    self.partition = partition
+    self.linkno = linkno
+    self.outbox = outbox # frames for the receiving partition
+    self.pending = deque() # (event key, receivers, frame length)
+
+  def settle(self, stats, before=None):
+    # deliveries ordered before the event before (all of them if None)
+    pending = self.pending
+    while pending and (before is None or pending[0][0] < before):
+      key, receivers, length = pending.popleft()
+      stats.frames_delivered = stats.frames_delivered + receivers
+      stats.bytes_delivered = stats.bytes_delivered + receivers * length
+      stats.in_flight = stats.in_flight - 1
+
+
+class PartitionSimulator(sim.Simulator):
+  def __init__(self, topology, partition, assignment, **kwargs):
+    self.partition = partition
+    self.assignment = assignment # partition of every node
+
+    sim.Simulator.__init__(self, topology, **kwargs)
+
+    others = set(assignment) - set([partition])
+    self.deliveries = dict([(p, []) for p in others])
+    self.registrations = dict([(p, []) for p in others])
+    self.remote_links = {} # Transmitter -> RemoteLink
+    self.lookahead = None
+
+    for node in self.nodes:
+      home = assignment[node.nodenumber]
+
+      if home != partition:
+        node.application_waiting = ForwardedWaiting(self.registrations[home],
+          node.nodenumber)
+        continue
+
+      for linkno, (link, transmitter) in enumerate(zip(node.links,
+          node.transmitters)):
+        destinations = link.get_destinations(node)
+        remote = set([assignment[peer.nodenumber]
+          for peer, port in destinations]) - set([partition])
+
+        if not remote:
+          continue
+
+        if len(destinations) != 1:
+          raise RuntimeError('link {} of {} has more than two ends, so cannot join partitions'.format(
+            linkno, node.nodeinfo.name))
+
+        delay = transmitter.linkinfo.propagationdelay
+        if delay <= 0:
+          raise RuntimeError('link {} of {} joins two partitions, so needs a propagationdelay'.format(
+            linkno, node.nodeinfo.name))
+
+        if self.lookahead is None or delay < self.lookahead:
+          self.lookahead = delay
+
+        home = remote.pop()
+        self.remote_links[transmitter] = RemoteLink(home, linkno,
+          self.deliveries[home])
+
+  def start_node(self, state, hostinfo):
+    # other partitions' nodes only have their links and counters here
+    if self.assignment[state.nodenumber] == self.partition:
+      sim.Simulator.start_node(self, state, hostinfo)
+
+  def open_stats_csv(self, stats_csv):
+    # rows are summed over the partitions by the coordinator
+    self.stats_csv_file = None
+    self.stats_csv_write = stats_csv
+    self.period_totals = []
+
+  def write_stats_row(self):
+    self.period_totals.append(self.stats_totals())
+
+  def schedule_delivery(self, transmitter, delivery, time):
+    remote = self.remote_links.get(transmitter)
+
+    if remote is None:
+      sim.Simulator.schedule_delivery(self, transmitter, delivery, time)
+      return
+
+    stats = transmitter.stats
+    if self.current_event is not None: # None while booting
+      remote.settle(stats, self.current_event)
+
+    stats.in_flight = stats.in_flight + 1
+    if stats.in_flight > stats.peak_in_flight:
+      stats.peak_in_flight = stats.in_flight
+
+    # the key the sequential engine would give the delivery
+    node = transmitter.node
+    node.events_scheduled = node.events_scheduled + 1
+    key = (time, self.current_time_usec, node.nodenumber,
+      node.events_scheduled)
+
+    remote.pending.append((key, len(delivery.receivers), len(delivery.frame)))
+    remote.outbox.append((key, node.nodenumber, remote.linkno, delivery.frame,
+      delivery.number))
+
+    delivery.frame = None
+    delivery.receivers = None
+    self.free_deliveries.append(delivery)
+
+  def receive(self, deliveries, registrations):
+    for nodenumber, key, time in registrations:
+      self.nodes[nodenumber].application_waiting[key] = time
+
+    # the receivers count the frames against their copy of the sender's
+    # LinkStats, which the coordinator ignores
+    for key, sendernumber, linkno, frame, number in deliveries:
+      sender = self.nodes[sendernumber]
+      link = sender.links[linkno]
+      delivery = sim.FrameDelivery(frame, link, link.get_destinations(sender),
+        sendernumber, number, sender.linkstats[linkno])
+      heapq.heappush(self.event_queue, key + (sim.FRAME_DELIVERY, delivery))
+
+  def run_window(self, end):
+    # run every event before end (None for no limit), returning the time of
+    # the next one
+    queue = self.event_queue
+
+    while queue and (end is None or queue[0][0] < end):
+      self.process_next_event()
+
+    self.flush()
+
+    if queue:
+      return queue[0][0]
+    return None
+
+  def outbox(self):
+    # what the last window shipped, by partition
+    shipped = {}
+
+    for p in self.deliveries:
+      if self.deliveries[p] or self.registrations[p]:
+        shipped[p] = (list(self.deliveries[p]), list(self.registrations[p]))
+        del self.deliveries[p][:]
+        del self.registrations[p][:]
+
+    return shipped
+
+  def finish(self, time, before):
+    self.current_time_usec = time
+
+    for transmitter, remote in self.remote_links.items():
+      remote.settle(transmitter.stats, before)
+
+    local = [node.nodenumber for node in self.nodes
+      if self.assignment[node.nodenumber] == self.partition]
+
+    links = dict([(n, []) for n in local])
+    senders = [node.nodenumber for node in self.nodes for link in node.links]
+    for nodenumber, counters in zip(senders, self.link_counters()):
+      if nodenumber in links:
+        links[nodenumber].append(counters)
+
+    nodes = dict([(n, counters) for n, counters
+      in zip(range(len(self.nodes)), self.node_counters()) if n in links])
+
+    latency = self.metrics.latency
+    return (self.counters(), self.total_delivery_time,
+      (latency.counts, latency.count, latency.maximum), links, nodes)
+
+
+def taken_output(output):
+  if output is None:
+    return ''
+
+  text = output.getvalue()
+  output.seek(0)
+  output.truncate()
+  return text
+
+
+def run_worker(connection, partition, assignment, topology, node_module,
+    options):
+  try:
+    if node_module is not None:
+      node_module = sim.load_node_module(node_module)
+
+    output = None
+    if not options['silent_nodes']:
+      output = io.StringIO()
+
+    simulator = PartitionSimulator(topology, partition, assignment,
+      node_module=node_module, node_output=output, **options)
+    simulator.boot_nodes()
+    simulator.flush()
+
+    next_time = None
+    if simulator.event_queue:
+      next_time = simulator.event_queue[0][0]
+
+    connection.send(('ready', simulator.lookahead, next_time,
+      simulator.current_time_usec, simulator.outbox(), taken_output(output),
+      []))
+
+    while True:
+      command = connection.recv()
+
+      if command[0] == 'window':
+        end, deliveries, registrations = command[1:]
+        simulator.receive(deliveries, registrations)
+        next_time = simulator.run_window(end)
+        totals = simulator.period_totals
+        simulator.period_totals = []
+        connection.send(('window', None, next_time,
+          simulator.current_time_usec, simulator.outbox(),
+          taken_output(output), totals))
+      else:
+        time, before = command[1:]
+        connection.send(('done',) + simulator.finish(time, before))
+        break
+
+    simulator.close()
+  except RuntimeError as e:
+    connection.send(('error', str(e)))
+  except EOFError:
+    pass # the coordinator gave up, another partition having failed
+  finally:
+    connection.close()
+
+
+# Runs a topology split over partitions worker processes, with the same
+# arguments as Simulator where they apply. Unlike a Simulator it runs once:
+# run() starts the workers, runs to the end and collects the results.
+class PartitionedSimulator:
+  def __init__(self, topology, partitions, node_module=None,
+      node_output=sys.stdout, silent_nodes=False, stats_period=None,
+      stats_csv=None, seed=None, isolate_nodes=True, log_level=LogLevel.INFO,
+      output_buffer_size=None, link_stats=None, node_stats=None,
+      payload_size=sim.DEFAULT_PAYLOAD_SIZE, payload_timestamps=False):
+    self.topology = topology
+    self.assignment = partition_hosts(topology, partitions)
+    self.partitions = partitions
+
+    if seed is None:
+      seed = secrets.randbits(64) # one seed for every worker
+    self.seed = seed
+
+    self.node_module = None
+    if node_module is not None:
+      self.node_module = node_module.__name__
+
+    self.options = {
+      'silent_nodes': silent_nodes,
+      'stats_period': stats_period,
+      'stats_csv': bool(stats_csv),
+      'seed': seed,
+      'isolate_nodes': isolate_nodes,
+      'log_level': log_level,
+      'payload_size': payload_size,
+      'payload_timestamps': payload_timestamps
+    }
+
+    self.node_output = None
+    if not silent_nodes:
+      self.node_output = BufferedOutput(node_output, output_buffer_size)
+
+    self.stats_csv_file = None
+    self.stats_csv_write = None
+    if stats_csv:
+      self.stats_csv_file = open(stats_csv, 'w', newline='')
+      self.stats_csv_write = csv.writer(self.stats_csv_file,
+        quoting=csv.QUOTE_MINIMAL)
+      self.stats_csv_write.writerow(sim.STATS_CSV_HEADER)
+
+    self.link_stats_path = link_stats
+    self.node_stats_path = node_stats
+    self.steady = None
+    self.windows = 0
+    self.results = None
+
+  def run(self, duration=None):
+    if self.results is not None:
+      raise RuntimeError('a partitioned simulation only runs once')
+
+    duration = sim.usecs_from_time(duration, 'execution duration')
+
+    connections = []
+    workers = []
+
+    for partition in range(self.partitions):
+      parent, child = multiprocessing.Pipe()
+      worker = multiprocessing.Process(target=run_worker, args=(child,
+        partition, self.assignment, self.topology, self.node_module,
+        self.options), daemon=True)
+      worker.start()
+      child.close()
+      connections.append(parent)
+      workers.append(worker)
+
+    try:
+      self.results = self.coordinate(connections, duration)
+    finally:
+      for connection in connections:
+        connection.close()
+      for worker in workers:
+        worker.join(1)
+        if worker.is_alive():
+          worker.terminate()
+
+    return self.counters()
+
+  def replies(self, connections):
+    replies = []
+
+    for partition, connection in enumerate(connections):
+      try:
+        reply = connection.recv()
+      except EOFError:
+        raise RuntimeError('partition {} stopped unexpectedly'.format(partition))
+
+      if reply[0] == 'error':
+        raise RuntimeError(reply[1])
+
+      replies.append(reply)
+
+    return replies
+
+  def coordinate(self, connections, duration):
+    replies = self.replies(connections)
+
+    lookahead = None
+    for reply in replies:
+      if reply[1] is not None and (lookahead is None or reply[1] < lookahead):
+        lookahead = reply[1]
+
+    while True:
+      inbox = [([], []) for connection in connections]
+      next_times = []
+
+      for kind, unused, next_time, time, shipped, output, totals in replies:
+        if next_time is not None:
+          next_times.append(next_time)
+
+        for partition, (deliveries, registrations) in shipped.items():
+          inbox[partition][0].extend(deliveries)
+          inbox[partition][1].extend(registrations)
+          next_times.extend([delivery[0][0] for delivery in deliveries])
+
+        if output:
+          self.node_output.write(output)
+
+      self.write_stats_rows([reply[6] for reply in replies])
+
+      next_time = None
+      if next_times:
+        next_time = min(next_times)
+
+      if next_time is None or (duration and next_time > duration):
+        break
+
+      end = None
+      if lookahead is not None:
+        end = next_time + lookahead
+      if duration and (end is None or end > duration):
+        end = duration + 1
+
+      for connection, (deliveries, registrations) in zip(connections, inbox):
+        connection.send(('window', end, deliveries, registrations))
+
+      self.windows = self.windows + 1
+      replies = self.replies(connections)
+
+    # as the sequential engine: stopped at the duration if events remain,
+    # else at the last event
+    if next_time is None:
+      time = max([reply[3] for reply in replies])
+      before = None
+    else:
+      time = duration
+      before = (duration + 1,)
+
+    for connection in connections:
+      connection.send(('finish', time, before))
+
+    return self.replies(connections)
+
+  def write_stats_rows(self, totals):
+    # one list of period totals per partition, the same periods in each
+    if not self.stats_csv_write:
+      return
+
+    for rows in zip(*totals):
+      summed = [rows[0][0]] + [sum(column) for column in list(zip(*rows))[1:]]
+      self.stats_csv_write.writerow(sim.stats_csv_row(*summed))
+
+  def counters(self):
+    if self.results is None:
+      raise RuntimeError('the partitioned simulation has not run yet')
+
+    counters = dict(self.results[0][1])
+
+    for name in ADDITIVE_COUNTERS:
+      counters[name] = sum([result[1][name] for result in self.results])
+
+    total_delivery_time = sum([result[2] for result in self.results])
+    row = sim.stats_csv_row(counters['time_usec'], counters['events_raised'],
+      counters['messages_generated'], counters['messages_delivered'],
+      total_delivery_time, counters['frames_transmitted'],
+      counters['frames_received'], counters['bytes_received_physical'],
+      counters['bytes_received_application'])
+    counters['average_delivery_time'] = row[4]
+    counters['efficiency'] = row[9]
+
+    latency = LatencyHistogram()
+    for result in self.results:
+      latency.merge(*result[3])
+    counters.update(latency.percentiles())
+
+    return counters
+
+  def link_counters(self):
+    counters = []
+    for nodenumber, partition in enumerate(self.assignment):
+      counters.extend(self.results[partition][4][nodenumber])
+    return counters
+
+  def node_counters(self):
+    return [self.results[partition][5][nodenumber]
+      for nodenumber, partition in enumerate(self.assignment)]
+
+  # the CSV writers only need link_counters() and node_counters()
+  write_link_stats = sim.Simulator.write_link_stats
+  write_node_stats = sim.Simulator.write_node_stats
+
+  def close(self):
+    if self.results is not None:
+      if self.link_stats_path:
+        self.write_link_stats(self.link_stats_path)
+      if self.node_stats_path:
+        self.write_node_stats(self.node_stats_path)
+    self.link_stats_path = None
+    self.node_stats_path = None
+
+    if self.node_output:
+      self.node_output.close()
+      self.node_output = None
+    if self.stats_csv_file:
+      self.stats_csv_file.close()
+      self.stats_csv_file = None
+      self.stats_csv_write = None
@@ -0,0 +1,121 @@
+import pickle
+
+# Recording and replay of the random decisions a simulation makes: each node's
+# message inter-arrival gaps, destinations and payloads, and the fate (lost,
+# or corrupted at some offset) of each frame sent on each (node, link).
+#
+# Replay hands the recorded values back in the same per-node and per-link
+# order, so a changed protocol sees the k-th message of every node with the
+# same gap, destination and payload, and the k-th frame it sends on a link
+# suffers the same loss or corruption. Once a stream runs out (the new
+# protocol sent more frames than the recorded one) decisions are drawn live
+# again, and counted in ReplaySource.exhausted.
+
+RECORDING_VERSION = 1
+
+
+class ChannelRecording:
+  def __init__(self):
+    self.gaps = {} # nodenumber -> [usecs, ...]
+    self.destinations = {} # nodenumber -> [nodenumber, ...]
+    self.payloads = {} # nodenumber -> [bytes, ...]
+    self.fates = {} # (nodenumber, linkno) -> [(lost, corrupt offset), ...]
+
+  def save(self, path):
+    with open(path, 'wb') as fout:
+      pickle.dump((RECORDING_VERSION, self.gaps, self.destinations,
+        self.payloads, self.fates), fout, protocol=pickle.HIGHEST_PROTOCOL)
+
+  @classmethod
+  def load(cls, path):
+    with open(path, 'rb') as fin:
+      data = pickle.load(fin)
+
+    if data[0] != RECORDING_VERSION:
+      raise RuntimeError('{} is not a channel recording this simulator can replay'.format(path))
+
+    recording = cls()
+    recording.gaps, recording.destinations, recording.payloads, \
+      recording.fates = data[1:]
+    return recording
+
+
+class RecordingSource:
+  # wraps the live source, keeping a copy of everything it decides
+  def __init__(self, live, recording):
+    self.live = live
+    self.recording = recording
+
+  def message_gap(self, node):
+    gap = self.live.message_gap(node)
+    self.recording.gaps.setdefault(node.nodenumber, []).append(gap)
+    return gap
+
+  def message_destination(self, node):
+    destnum = self.live.message_destination(node)
+    self.recording.destinations.setdefault(node.nodenumber, []).append(destnum)
+    return destnum
+
+  def message_payload(self, node):
+    payload = self.live.message_payload(node)
+    self.recording.payloads.setdefault(node.nodenumber, []).append(payload)
+    return payload
+
+  def frame_fate(self, node, linkno, length):
+    fate = self.live.frame_fate(node, linkno, length)
+    self.recording.fates.setdefault((node.nodenumber, linkno), []).append(fate)
+    return fate
+
+
+class ReplaySource:
+  def __init__(self, live, recording, simulator):
+    self.live = live
+    self.simulator = simulator
+    self.gaps = streams(recording.gaps)
+    self.destinations = streams(recording.destinations)
+    self.payloads = streams(recording.payloads)
+    self.fates = streams(recording.fates)
+    self.exhausted = 0 # decisions that had to be drawn live
+
+  def next(self, table, key):
+    stream = table.get(key)
+    if stream is None:
+      return None
+    return next(stream, None)
+
+  def message_gap(self, node):
+    gap = self.next(self.gaps, node.nodenumber)
+    if gap is None:
+      self.exhausted = self.exhausted + 1
+      return self.live.message_gap(node)
+    return gap
+
+  def message_destination(self, node):
+    destnum = self.next(self.destinations, node.nodenumber)
+    if destnum is None or not self.simulator.may_send_to(node, destnum):
+      self.exhausted = self.exhausted + 1
+      return self.live.message_destination(node)
+    return destnum
+
+  def message_payload(self, node):
+    payload = self.next(self.payloads, node.nodenumber)
+    if payload is None:
+      self.exhausted = self.exhausted + 1
+      return self.live.message_payload(node)
+    return payload
+
+  def frame_fate(self, node, linkno, length):
+    fate = self.next(self.fates, (node.nodenumber, linkno))
+    if fate is None:
+      self.exhausted = self.exhausted + 1
+      return self.live.frame_fate(node, linkno, length)
+
+    lost, offset = fate
+    if offset is not None and offset >= length - 2:
+      # the new build sent a shorter frame than the recorded one
+      offset = offset % (length - 2) if length > 2 else None
+    return (lost, offset)
+
+
+def streams(table):
+  return dict([(key, iter(values)) for key, values in table.items()])
@@ -0,0 +1,38 @@
+import hashlib
+import random
+import functools
+
+# Independent random number streams derived from one master seed.
+#
+# Every consumer of randomness gets its own stream, named by a key such as
+# ('arrivals', 'Perth') or ('channel', 'Perth', 'Melbourne'). A stream's seed
+# is a hash of the master seed and its key, so it depends on nothing else: a
+# node or link added to the topology, or extra frames sent by a changed
+# protocol, leave every other stream's values where they were. This plays the
+# part of NumPy's SeedSequence.spawn(), but keyed by name rather than by spawn
+# order. Streams are random.Random, never NumPy generators, so a seed means
+# the same run whether or not NumPy is installed.
+
+
+def derive_seed(seed, *key):
+  digest = hashlib.blake2b(repr((seed,) + key).encode('utf-8'),
+    digest_size=16).digest()
+  return int.from_bytes(digest, 'little')
+
+
+class RandomStreams:
+  def __init__(self, seed):
+    self.seed = seed
+
+  def seed_for(self, *key):
+    return derive_seed(self.seed, *key)
+
+  def deferred_seed(self, *key):
+    # a function returning the stream's seed, for consumers that may never
+    # draw from it, such as the channels of links that carry no frames
+    return functools.partial(derive_seed, self.seed, *key)
+
+  def python(self, *key):
+    # a random.Random for the stream
+    return random.Random(self.seed_for(*key))
+
@@ -1,5 +1,7 @@
 import sys
+import gc
 import importlib
+import importlib.util
 import inspect
 import secrets
 import heapq
@@ -9,61 +11,25 @@ import traceback
 import csv
 import argparse
 import json
-import re
+from collections import deque
+
+from defs import Event, LinkType, LinkInfo, LogLevel, QueuePolicy
+from nodelog import BufferedOutput, ignore_output
+from replay import ChannelRecording, RecordingSource, ReplaySource
+from metrics import MetricsStore, check_metrics_path
+from eventtrace import TraceWriter, TraceKind, TRACE_LOST, TRACE_CORRUPTED, \
+  TRACE_REJECTED, TRACE_DROPPED
+from timers import TimerTable
+from arrivals import PoissonArrivals
+from rngstreams import RandomStreams
+from payloads import CompactPayloads
+from channels import LegacyChannel, build_channel
+from snapshot import save_snapshot, load_snapshot
+from steadystate import SteadyStateMonitor, METRICS as STEADY_METRICS
+from topology import TIME_SUFFIX_TO_USEC, PROBABILITY_KEYS, \
+  CHANNEL_PROBABILITIES, usecs_from_time, link_parameter, fold_probabilities, \
+  compile_topology
 
-from defs import Event, LinkType, LinkInfo
-
-
-parser = argparse.ArgumentParser(prog='Network Simulator')
-
-parser.add_argument('-e', '--execution-duration', nargs='?')
-
-parser.add_argument('--node-output', nargs='?', type=argparse.FileType('w'),
-  default=sys.stdout)
-
-parser.add_argument('--silent-nodes', action='store_true')
-
-parser.add_argument('--stats-period', nargs='?')
-
-parser.add_argument('--stats-csv', nargs='?')
-
-parser.add_argument('-S', '--seed', nargs='?', type=int)
-
-parser.add_argument('topology')
-
-args = parser.parse_args()
-
-
-# try to parse the topology file and load the user's module
-
-with open(args.topology, 'r') as fin:
-  topology = json.load(fin)
-
-try:
-  node_module = importlib.import_module(topology['module'])
-except ImportError:
-  print('failed to import module {}'.format(topology['module']))
-  exit(1)
-
-def is_node_class(what):
-  if inspect.isclass(what) and what.__name__ == 'Node':
-    return True
-  return False
-
-mod_classes = inspect.getmembers(node_module, is_node_class)
-
-if (len(mod_classes) < 1):
-  print('module {} does not define a Node class'.format(topology['module']))
-  exit(1)
-
-
-probframecorrupt = 0
-if 'probframecorrupt' in topology:
-  probframecorrupt = 1 << int(topology['probframecorrupt'])
-
-probframeloss = 0
-if 'probframeloss' in topology:
-  probframeloss = 1 << int(topology['probframeloss'])
 
 # The following code adapted from
 # The cnet network simulator (v3.4.1)
@@ -98,89 +64,231 @@ def poisson_usecs(mean_usecs):
 
 MAY_CORRUPT_FRAMES = False
 
-TIME_SUFFIX_TO_USEC = {
-  'us':                1,
-  'ms':             1000,
-  's':           1000000,
-  'm':      60 * 1000000,
-  'h': 60 * 60 * 1000000
+DEFAULT_STATS_PERIOD = 10000000
+
+# kinds of entry in the simulator's event queue
+APPLICATION_MESSAGE = 0
+FRAME_DELIVERY = 1
+TIMER_EXPIRY = 2
+STATS_PERIOD = 3
+TRANSMITTER_READY = 4
+
+RNG_MODES = ('streams', 'legacy')
+PAYLOAD_MODES = ('compact', 'random')
+DEFAULT_PAYLOAD_SIZE = 50
+
+# arguments the simulator passes to the handler of each event; handlers
+# registered with fewer parameters get only the leading ones
+EVENT_HANDLER_ARGS = {
+  Event.PHYSICALREADY: 2,
+  Event.APPLICATIONREADY: 2,
+  Event.TIMER0: 1,
+  Event.TIMER1: 1,
+  Event.TIMER2: 1,
+  Event.TIMER3: 1,
+  Event.TIMER4: 1,
+  Event.TIMER5: 1,
+  Event.TIMER6: 1
 }
 
-BANDWIDTH_SUFFIX_TO_BITS_PER_SEC = {
-   'bps': 1,
-  'Kbps': 1<<10,
-  'Mbps': 1<<20,
-  'Gbps': 1<<30
-}
+STATS_CSV_HEADER = ['Time (usec)', 'Events Raised',
+  'Messages Generated', 'Messages Delivered',
+  'Average Delivery Time (usec)',
+  'Frames Transmitted', 'Frames Received',
+  'Bytes Received (Physical)', 'Bytes Received (Application)',
+  'Efficiency (AL/PL)']
 
+LINK_STATS_CSV_HEADER = ['Node', 'Link', 'To', 'Frames Sent', 'Bytes Sent',
+  'Frames Lost', 'Frames Corrupted', 'Frames Dropped', 'Frames Delivered',
+  'Bytes Delivered', 'Busy Time (usec)', 'Utilisation', 'Queue Time (usec)',
+  'Queued', 'Peak Queued', 'In Flight', 'Peak In Flight']
 
-def usecs_from_time_str(s):
-  s = s.strip()
-  
-  match = re.match(r'(\d+)\s*(.*)', s)
-  
-  if match:
-    digits, suffix = match.group(1, 2)
-    
-    digits = int(digits)
+NODE_STATS_CSV_HEADER = ['Node', 'Frames Sent', 'Bytes Sent',
+  'Frames Received', 'Bytes Received', 'Messages Generated',
+  'Messages Delivered', 'Bytes Delivered']
+
+
+def stats_csv_row(time, events_raised, messages_generated, messages_delivered,
+    total_delivery_time, frames_transmitted, frames_received,
+    bytes_received_physical, bytes_received_application):
+  average_delivery_time = 0
+
+  if messages_delivered:
+    average_delivery_time = total_delivery_time // messages_delivered
+
+  efficiency = 1
+  if bytes_received_physical:
+    efficiency = bytes_received_application / bytes_received_physical
+
+  return [time, events_raised, messages_generated, messages_delivered,
+    average_delivery_time, frames_transmitted, frames_received,
+    bytes_received_physical, bytes_received_application, efficiency]
+
+
+def load_node_module(name):
+  try:
+    node_module = importlib.import_module(name)
+  except ImportError:
+    raise RuntimeError('failed to import module {}'.format(name))
+
+  if not inspect.getmembers(node_module, is_node_class):
+    raise RuntimeError('module {} does not define a Node class'.format(name))
+
+  return node_module
 
-    if suffix:
-      if suffix in TIME_SUFFIX_TO_USEC:
-        digits = digits * TIME_SUFFIX_TO_USEC[suffix]
-      else:
-        raise RuntimeError('unknown time suffix {}'.format(suffix))
-    
-    return digits
-  
-  raise RuntimeError('invalid time string {}'.format(s))
-
-
-def bps_from_bandwidth_str(s):
-  s = s.strip()
-  
-  match = re.match(r'(\d+)\s*(.*)', s)
-  
-  if match:
-    digits, suffix = match.group(1, 2)
-    
-    digits = int(digits)
-
-    if suffix:
-      if suffix in BANDWIDTH_SUFFIX_TO_BITS_PER_SEC:
-        digits = digits * BANDWIDTH_SUFFIX_TO_BITS_PER_SEC[suffix]
-      else:
-        raise RuntimeError('unknown bandwidth suffix {}'.format(suffix))
-    
-    return digits
-  
-  raise RuntimeError('invalid bandwidth string {}'.format(s))
 
+def isolated_module_instance(node_module, code_cache):
+  # a fresh copy of node_module with its own globals, so that nodes running
+  # the same protocol share no module state
+  spec = node_module.__spec__
+  if spec is None or spec.loader is None or not hasattr(spec.loader, 'get_code'):
+    raise RuntimeError('cannot isolate module {}'.format(node_module.__name__))
+
+  code = code_cache.get(spec.name)
+  if code is None:
+    code = spec.loader.get_code(spec.name)
+    code_cache[spec.name] = code
+
+  instance = importlib.util.module_from_spec(spec)
+  exec(code, instance.__dict__)
+  return instance
+
+
+# a handler taking fewer arguments than its event provides, called with just
+# the leading ones (a class rather than a lambda so that it can be pickled)
+class AdaptedHandler:
+  __slots__ = ('callback', 'numargs')
+
+  def __init__(self, callback, numargs):
+    self.callback = callback
+    self.numargs = numargs
+
+  def __call__(self, *args):
+    return self.callback(*args[:self.numargs])
+
+
+def adapt_handler(callback, event):
+  numargs = len(inspect.signature(callback).parameters)
+
+  if numargs >= EVENT_HANDLER_ARGS.get(event, numargs + 1):
+    return callback
+
+  return AdaptedHandler(callback, numargs)
+
+
+def is_node_class(what):
+  if inspect.isclass(what) and what.__name__ == 'Node':
+    return True
+  return False
+
+
+# The random decisions the simulator makes, drawn live. See replay.py for
+# recording them and for feeding recorded ones back.
+#
+# With rng='streams' every node draws its message gaps (in blocks, see
+# arrivals.py), destinations and random payloads from streams of its own
+# derived from the seed (see rngstreams.py). With rng='legacy' everything
+# comes from the random module, one gap at a time from poisson_usecs(), and
+# random payloads from secrets, reproducing runs of earlier versions.
+class LiveSource:
+  def __init__(self, simulator, streams, rng='streams'):
+    if rng not in RNG_MODES:
+      raise RuntimeError('unknown random number generation {}'.format(rng))
+
+    self.simulator = simulator
+    self.streams = streams
+    self.arrivals = {} # nodenumber -> PoissonArrivals
+    self.destinations = {} # nodenumber -> random.Random
+    self.payloads = None
+
+    if rng == 'legacy':
+      self.message_gap = self.legacy_message_gap
+      self.message_destination = self.legacy_message_destination
+      self.message_payload = self.legacy_message_payload
+
+  def message_gap(self, node):
+    arrivals = self.arrivals.get(node.nodenumber)
+
+    if arrivals is None:
+      arrivals = PoissonArrivals(node.messagerate,
+        self.streams.seed_for('arrivals', node.nodeinfo.name))
+      self.arrivals[node.nodenumber] = arrivals
+    elif arrivals.mean_usecs != node.messagerate:
+      arrivals.set_mean(node.messagerate) # after set_parameter()
+
+    return arrivals.next()
+
+  def message_destination(self, node):
+    rng = self.destinations.get(node.nodenumber)
+
+    if rng is None:
+      rng = self.streams.python('destinations', node.nodeinfo.name)
+      self.destinations[node.nodenumber] = rng
+
+    return self.simulator.choose_application_destination(node, rng)
+
+  def message_payload(self, node):
+    if self.payloads is None:
+      self.payloads = self.streams.python('payloads')
+    return self.payloads.randbytes(self.simulator.payload_size)
+
+  def legacy_message_gap(self, node):
+    return poisson_usecs(node.messagerate)
+
+  def legacy_message_destination(self, node):
+    return self.simulator.choose_application_destination(node, random)
+
+  def legacy_message_payload(self, node):
+    return secrets.token_bytes(self.simulator.payload_size)
+
+  # returns (lost, offset of the corrupted bytes or None)
+  def frame_fate(self, node, linkno, length):
+    return node.linkinfos[linkno].channel.fate(length)
+
+
+# Links know which port (index into the node's links) each attached node uses
+# them on. get_destinations() returns (node, port) for every node a frame from
+# sender reaches; the tuple is built once per sender and then reused.
 
 class LinkLoopback:
   def __init__(self):
     self.node = None
+    self.destinations = ()
 
-  def node_added(self, node):
+  def node_added(self, node, port):
     if self.node != None:
       raise RuntimeError('loopback shared by multiple nodes?')
     self.node = node
-  
-  def get_destination_nodes(self, sender):
-    return [self.node]
+    self.destinations = ((node, port),)
+
+  def get_destinations(self, sender):
+    return self.destinations
 
 
 class LinkWAN:
   def __init__(self):
     self.nodes = []
-  
-  def node_added(self, node):
+    self.ports = {} # node -> port number of this link on that node
+    self.destinations = {} # sender -> ((node, port), ...)
+
+  def node_added(self, node, port):
     self.nodes.append(node)
-  
-  def get_destination_nodes(self, sender):
-    return [x for x in self.nodes if x != sender]
+    self.ports[node] = port
+    self.destinations = {}
+
+  def get_destinations(self, sender):
+    destinations = self.destinations.get(sender)
+
+    if destinations is None:
+      destinations = tuple([(x, self.ports[x]) for x in self.nodes if x != sender])
+      self.destinations[sender] = destinations
+
+    return destinations
 
 
 class NodeInfo:
+  __slots__ = ('nodenumber', 'name', 'linkinfo')
+
   def __init__(self, nodenumber, name):
     self.nodenumber = nodenumber
     self.name = name
@@ -188,149 +296,282 @@ class NodeInfo:
 
 
 class NodeState:
-  def __init__(self, nodeinfo, hostinfo):
+  __slots__ = ('nodenumber', 'nodeinfo', 'module', 'shared_module', 'impl',
+    'handlers', 'links', 'linkinfos', 'messagerate', 'application_enabled',
+    'application_to_all', 'application_destinations',
+    'application_destination_index', 'application_waiting',
+    'next_message_usec', 'application_scheduled', 'linkstats', 'transmitters',
+    'frames_received', 'bytes_received', 'messages_generated',
+    'messages_delivered', 'bytes_delivered', 'events_scheduled')
+
+  def __init__(self, nodeinfo, messagerate):
     self.nodenumber = nodeinfo.nodenumber
     self.nodeinfo = nodeinfo
+    self.module = None # module (or isolated copy of it) defining impl's class
+    self.shared_module = False # module's nodeinfo must be rebound per event
     self.impl = None
-    self.handlers = {}
-    self.handler_num_args = {}
+    self.handlers = {} # event -> handler, already adapted to its arguments
     self.links = []
     self.linkinfos = []
-    self.messagerate = TIME_SUFFIX_TO_USEC['s']
+    self.linkstats = [] # LinkStats for frames this node sends on each link
+    self.transmitters = [] # Transmitter sending this node's frames on each link
+    self.messagerate = messagerate
     self.application_enabled = False
+    # either every other node (application_to_all) or the nodes listed in
+    # application_destinations, indexed so that removal is O(1)
+    self.application_to_all = False
     self.application_destinations = []
+    self.application_destination_index = {}
     self.application_waiting = {}
     self.next_message_usec = -1
+    self.application_scheduled = False
+
+    self.frames_received = 0
+    self.bytes_received = 0
+    self.messages_generated = 0
+    self.messages_delivered = 0
+    self.bytes_delivered = 0
+    self.events_scheduled = 0 # see Simulator.schedule()
+
+  def add_application_destination(self, nodenumber):
+    if nodenumber in self.application_destination_index:
+      return
+    self.application_destination_index[nodenumber] = len(self.application_destinations)
+    self.application_destinations.append(nodenumber)
+
+  def remove_application_destination(self, nodenumber):
+    index = self.application_destination_index.pop(nodenumber, None)
+    if index is None:
+      return
+    last = self.application_destinations.pop()
+    if last != nodenumber:
+      self.application_destinations[index] = last
+      self.application_destination_index[last] = index
 
-    if 'messagerate' in hostinfo and hostinfo['messagerate']:
-      try:
-        self.messagerate = usecs_from_time_str(hostinfo['messagerate'])
-      except:
-        print('failed to set messagerate={}'.format(hostinfo['messagerate']))
-        exit(1)
-    elif 'messagerate' in topology and topology['messagerate']:
-      try:
-        self.messagerate = usecs_from_time_str(topology['messagerate'])
-      except:
-        print('failed to set messagerate={}'.format(topology['messagerate']))
-        exit(1)
-  
   def add_link(self, link, linkinfo):
     self.links.append(link)
     self.linkinfos.append(linkinfo)
+    stats = LinkStats()
+    self.linkstats.append(stats)
+    self.transmitters.append(Transmitter(self, len(self.links) - 1, linkinfo,
+      stats))
     self.nodeinfo.linkinfo.append(linkinfo)
-    link.node_added(self)
+    link.node_added(self, len(self.links) - 1)
 
 
-class FrameDelivery:
-  def __init__(self, frame, link, receivers):
-    self.frame = frame
-    self.link = link
-    self.receivers = receivers
-  
-  def __eq__(self, other):
-    return True
-
-  def __ne__(self, other):
-    return False
-
-  def __lt__(self, other):
-    return False
-
-  def __le__(self, other):
-    return True
+# Counters for the frames one node sends on one of its links, i.e. for one
+# direction of a WAN link. busy_usec is the time spent serialising frames onto
+# the link at its bandwidth, queue_usec the time frames spent waiting for it.
+class LinkStats:
+  __slots__ = ('frames_sent', 'bytes_sent', 'frames_lost', 'frames_corrupted',
+    'frames_dropped', 'frames_delivered', 'bytes_delivered', 'busy_usec',
+    'queue_usec', 'peak_queued', 'in_flight', 'peak_in_flight')
 
-  def __gt__(self, other):
-    return False
+  def __init__(self):
+    self.frames_sent = 0
+    self.bytes_sent = 0
+    self.frames_lost = 0
+    self.frames_corrupted = 0
+    self.frames_dropped = 0
+    self.frames_delivered = 0
+    self.bytes_delivered = 0
+    self.busy_usec = 0
+    self.queue_usec = 0
+    self.peak_queued = 0
+    self.in_flight = 0
+    self.peak_in_flight = 0
+
+
+# The sending side of one direction of a link. Frames are put on the link one
+# after another at its bandwidth; a frame written while an earlier one is
+# still being sent waits in queue, holding at most linkinfo.txqueuelength
+# frames. Queued entries are (frame, transmission usecs, time queued). A
+# frame is only counted as sent, numbered and given its fate by the channel
+# when it starts onto the link (see Simulator.start_transmission()), so one
+# dropped from the queue under either policy counts just as dropped.
+#
+# The event queue only gets a TRANSMITTER_READY entry, for when the frame
+# being sent is done, while frames are waiting; a frame written to an idle
+# transmitter is scheduled for delivery straight away.
+class Transmitter:
+  __slots__ = ('node', 'linkno', 'linkinfo', 'stats', 'busy_until', 'queue',
+    'wakeup_pending')
+
+  def __init__(self, node, linkno, linkinfo, stats):
+    self.node = node # NodeState of the sender
+    self.linkno = linkno
+    self.linkinfo = linkinfo
+    self.stats = stats
+    self.busy_until = 0
+    self.queue = None # a deque, made when a frame first has to wait
+    self.wakeup_pending = False
 
-  def __ge__(self, other):
-    return True
 
+class FrameDelivery:
+  __slots__ = ('frame', 'link', 'receivers', 'sender', 'number', 'stats')
 
-class Timer:
-  def __init__(self, timeout, timerid, nodenumber, event, data):
-    self.timeout = timeout
-    self.timerid = timerid
-    self.nodenumber = nodenumber
-    self.event = event
-    self.data = data
-    self.cancelled = False
+  def __init__(self, frame, link, receivers, sender, number, stats):
+    self.frame = frame
+    self.link = link
+    self.receivers = receivers
+    self.sender = sender
+    self.number = number # position among all frames transmitted
+    self.stats = stats # LinkStats of the sending side
+
+
+# A simulator is built from a parsed topology dict and the protocol module
+# defining Node (imported from topology['module'] if not given). A host may
+# name its own "module", so different protocols can share one simulation.
+# Frames on each direction of a link are sent one at a time at its bandwidth,
+# waiting in a transmit queue of "txqueuelength" frames (unbounded if not
+# given) that is "droptail" or "drophead" per "txqueuepolicy".
+# Nothing is read from the command line, so many simulators can be built and
+# run in the same process.
+#
+# Node output goes through a large buffer (drained by a background thread
+# with output_thread=True). Nodes may call print(), which logs at INFO, or
+# log(level, message, *args), which only formats message when level is at
+# least log_level. With silent_nodes both are no-ops.
+#
+# Every stats period the counters are written to stats_csv (cumulative) and,
+# when metrics is a path, recorded per interval in a MetricsStore that is
+# saved there (.csv or .npz) on close(). Delivery latency percentiles are
+# always tracked and reported by counters(). With precision set, the
+# periods also feed a SteadyStateMonitor (steadystate.py): after a warm-up
+# (steady_warmup, or found by MSER-5) it keeps batch-means confidence
+# intervals on steady_metrics and stops the run once each half-width is
+# within precision of its mean; counters() then includes the estimates.
+# link_counters() and node_counters() break the traffic down per link
+# direction and per node; link_stats and node_stats name CSV files they are
+# written to on close().
+#
+# With trace set to a path, every engine event is also recorded there, see
+# eventtrace.py. record_channel saves the random decisions of the run to a
+# file on close(); replay_channel (a path or ChannelRecording) feeds such a
+# recording back in, see replay.py.
+#
+# Each node's message gaps and destinations, each link's channel and the
+# payloads come from independent random streams derived from seed, so one
+# of them changing leaves the others alone; rng='legacy' draws everything
+# from the random module as before. Messages are compact payloads of
+# payload_size bytes carrying their id (payloads.py) and are tracked by that
+# id; payload='random' sends random bytes tracked by content as before, and
+# is the only mode whose payloads are recorded for replay.
+#
+# snapshot() saves the whole state of a simulation to a file, and
+# from_snapshot() builds a simulator that carries on from it, typically with
+# some parameters changed by set_parameter(), so that many runs can share
+# one warm-up. Outputs are not part of a snapshot and are given again.
+#
+# PartitionedSimulator (parallel.py) runs one topology split over several
+# processes, with the same results as a Simulator given the same seed.
+#
+# By default every node gets an isolated copy of its module, with its own
+# globals and nodeinfo/linkinfo bound once. With isolate_nodes=False nodes
+# share the imported module, whose nodeinfo and linkinfo globals are rebound
+# whenever a different node handles an event; protocols that never read them
+# while handling events can set NEEDS_NODE_GLOBALS = False to skip that.
+class Simulator:
+  def __init__(self, topology, node_module=None, node_output=sys.stdout,
+      silent_nodes=False, stats_period=None, stats_csv=None, seed=None,
+      isolate_nodes=True, log_level=LogLevel.INFO, output_buffer_size=None,
+      output_thread=False, trace=None, record_channel=None,
+      replay_channel=None, metrics=None, link_stats=None, node_stats=None,
+      rng='streams', payload='compact',
+      payload_size=DEFAULT_PAYLOAD_SIZE, payload_timestamps=False,
+      precision=None, steady_metrics=STEADY_METRICS, confidence=0.95,
+      steady_warmup=None):
+    check_metrics_path(metrics)
+
+    if node_module is None and 'module' in topology:
+      node_module = load_node_module(topology['module'])
+
+    self.topology = topology
+    self.node_module = node_module
+    self.silent_nodes = silent_nodes
+    self.log_level = log_level
+
+    if silent_nodes:
+      self.node_output = None
+    else:
+      self.node_output = BufferedOutput(node_output, output_buffer_size,
+        output_thread)
+    self.isolate_nodes = isolate_nodes
 
-  def __eq__(self, other):
-    return self.timeout == other.timeout
+    self.trace = None
+    if trace:
+      self.trace = TraceWriter(trace)
 
-  def __ne__(self, other):
-    return self.timeout != other.timeout
+    if seed is None:
+      seed = secrets.randbits(64)
+    else:
+      random.seed(seed)
+    self.seed = seed
+    self.rng = rng
+    self.streams = RandomStreams(seed)
 
-  def __lt__(self, other):
-    return self.timeout < other.timeout
+    self.source = LiveSource(self, self.streams, rng)
 
-  def __le__(self, other):
-    return self.timeout <= other.timeout
+    if payload not in PAYLOAD_MODES:
+      raise RuntimeError('unknown payload mode {}'.format(payload))
 
-  def __gt__(self, other):
-    return self.timeout > other.timeout
+    self.payload_size = payload_size
+    self.payloads = None
+    if payload == 'compact':
+      self.payloads = CompactPayloads(payload_size,
+        self.streams.seed_for('payloads'), payload_timestamps)
 
-  def __ge__(self, other):
-    return self.timeout >= other.timeout
+    self.record_channel = record_channel
+    self.recording = None
+    if record_channel:
+      self.recording = ChannelRecording()
+      self.source = RecordingSource(self.source, self.recording)
 
+    if replay_channel:
+      if not isinstance(replay_channel, ChannelRecording):
+        replay_channel = ChannelRecording.load(replay_channel)
+      self.source = ReplaySource(self.source, replay_channel, self)
 
-def earliest(times):
-  earliest = None
-  for t in times:
-    if earliest == None or (t != None and t < earliest):
-      earliest = t
-  return earliest
+    self.modules = {} # module name -> imported module
+    self.module_code = {} # module name -> code object for isolated copies
 
+    if node_module is not None:
+      self.modules[node_module.__name__] = node_module
 
-class Simulator:
-  def __init__(self):
     self.nodes = []
 
-    self.nodes_with_application_enabled = []
-
     self.current_index = None
+    self.booted = False
 
     self.current_time_usec = 0 # simulation time in usec
     self.duration_usec = None
 
-    if args.execution_duration:
-      try:
-        self.duration_usec = usecs_from_time_str(args.execution_duration)
-      except:
-        print('invalid execution duration {}'.format(args.execution_duration))
-        exit(1)
+    # every pending event as (time, scheduled at, origin, sequence, kind,
+    # item), see schedule()
+    self.event_queue = []
+    self.events_scheduled = 0 # sequence of events with no origin node
+    self.current_event = None # entry being processed
+    self.free_deliveries = [] # FrameDelivery records ready for reuse
 
-    self.event_queue = [] # waiting frame arrivals, in order
+    # (node number, link number) -> (channel keys, seed, name, rng) each WAN
+    # link direction's channel was built from, so set_parameter() can
+    # rebuild it
+    self.channel_specs = {}
 
     self.timers_created = 0
-    self.timer_queue = [] # current timers, in order
-    self.timer_map = {} # lookup from timerID to timer queue entry
+    self.timers = TimerTable()
 
-    if args.stats_csv:
-      fout = open(args.stats_csv, 'w', newline='')
+    self.open_stats_csv(stats_csv)
 
-      self.stats_csv_write = csv.writer(fout, quoting=csv.QUOTE_MINIMAL)
+    self.stats_period = DEFAULT_STATS_PERIOD
 
-      self.stats_csv_write.writerow(['Time (usec)', 'Events Raised',
-        'Messages Generated', 'Messages Delivered',
-        'Average Delivery Time (usec)',
-        'Frames Transmitted', 'Frames Received',
-        'Bytes Received (Physical)', 'Bytes Received (Application)',
-        'Efficiency (AL/PL)'])
-    else:
-      self.stats_csv_write = None
+    if stats_period:
+      self.stats_period = usecs_from_time(stats_period, 'stats period')
 
-    self.stats_period = 10000000
-    self.next_stats_print_usec = 10000000
-    
-    if args.stats_period:
-      try:
-        self.stats_period = usecs_from_time_str(args.stats_period)
-        self.next_stats_print_usec = self.stats_period
-      except:
-        print('invalid stats period {}'.format(args.stats_period))
-        exit(1)
+    self.metrics_path = metrics
+    self.metrics = MetricsStore()
+    self.link_stats_path = link_stats
+    self.node_stats_path = node_stats
 
     self.events_raised = 0
     self.messages_generated = 0
@@ -338,249 +579,732 @@ class Simulator:
     self.total_delivery_time = 0
     self.frames_transmitted = 0
     self.frames_received = 0
+    self.frames_dropped = 0
     self.bytes_received_physical = 0
     self.bytes_received_application = 0
 
-    node_module.print = self.intercepted_print
-    node_module.enable_application = self.enable_application
-    node_module.disable_application = self.disable_application
-    node_module.start_timer = self.start_timer
-    node_module.stop_timer = self.stop_timer
-    node_module.timer_data = self.timer_data
-    node_module.set_handler = self.set_handler
-    node_module.write_physical = self.write_physical
-    node_module.write_application = self.write_application
-
-  def add_node(self, hostinfo):
-    name = hostinfo['name']
+    self.steady = None
+    if precision:
+      self.track_steady_state(precision, steady_metrics, confidence,
+        steady_warmup)
+
+    self.schedule_stats_period()
+
+    self.load_topology(topology)
+
+  def load_topology(self, topology):
+    # everything built here lasts the whole run, so the cyclic collector
+    # would only walk it again and again as it grows
+    collecting = gc.isenabled()
+    gc.disable()
+
+    try:
+      self.build_topology(compile_topology(topology))
+    finally:
+      if collecting:
+        gc.enable()
+
+  def build_topology(self, compiled):
+    self.messagerate = compiled.messagerate
+
+    for name, hostinfo, messagerate in compiled.hosts:
+      self.add_node(name, hostinfo, messagerate)
+
+    # links are numbered on each node in the order the topology gives them
+    channels = [] # (channel keys, node, port, node at the other end)
+    for a, b, forward, backward in compiled.links:
+      node1 = self.nodes[a]
+      node2 = self.nodes[b]
+      wan = LinkWAN()
+      node1.add_link(wan, forward.linkinfo())
+      node2.add_link(wan, backward.linkinfo())
+      channels.append((forward.channel, node1, len(node1.links) - 1, node2))
+      channels.append((backward.channel, node2, len(node2.links) - 1, node1))
+
+    for spec, node, port, peer in channels:
+      linkinfo = node.linkinfos[port]
+
+      # streams are named by both ends, so adding a link leaves others
+      # alone; each is only seeded once its link sends a frame
+      seed = self.streams.deferred_seed('channel', node.nodeinfo.name,
+        peer.nodeinfo.name)
+
+      rng = None # a stream of its own, see build_channel()
+      if self.rng == 'legacy':
+        rng = random
+
+      what = '{} link {}'.format(node.nodeinfo.name, port)
+      linkinfo.channel = build_channel(spec, linkinfo, seed, what, rng)
+      self.channel_specs[(node.nodeinfo.nodenumber, port)] = (spec, seed,
+        what, rng)
+
+  def install_api(self, module):
+    if self.silent_nodes:
+      module.print = ignore_output
+      module.log = ignore_output
+    else:
+      if self.log_level <= LogLevel.INFO:
+        module.print = self.intercepted_print
+      else:
+        module.print = ignore_output
+      module.log = self.node_log
+    module.enable_application = self.enable_application
+    module.disable_application = self.disable_application
+    module.start_timer = self.start_timer
+    module.stop_timer = self.stop_timer
+    module.timer_data = self.timer_data
+    module.set_handler = self.set_handler
+    module.write_physical = self.write_physical
+    module.write_application = self.write_application
+
+  def module_for_host(self, hostinfo):
+    if 'module' in hostinfo and hostinfo['module']:
+      name = hostinfo['module']
+      if not name in self.modules:
+        self.modules[name] = load_node_module(name)
+      node_module = self.modules[name]
+    elif self.node_module is not None:
+      node_module = self.node_module
+    else:
+      raise RuntimeError('no module given for host {}'.format(hostinfo['name']))
+
+    if self.isolate_nodes:
+      node_module = isolated_module_instance(node_module, self.module_code)
+
+    self.install_api(node_module)
+    return node_module
+
+  def add_node(self, name, hostinfo, messagerate):
     info = NodeInfo(len(self.nodes), name)
-    state = NodeState(info, hostinfo)
-    state.add_link(LinkLoopback(), LinkInfo(LinkType.LOOPBACK, 0, 0, 0, 0))
+    state = NodeState(info, messagerate)
+    loopback = LinkInfo(LinkType.LOOPBACK, 0, 0, 0, 0)
+    loopback.channel = LegacyChannel(loopback)
+    state.add_link(LinkLoopback(), loopback)
     self.nodes.append(state)
+    self.start_node(state, hostinfo)
+    return state
 
-    self.current_index = info.nodenumber
-    node_module.nodeinfo = info
-    node_module.linkinfo = info.linkinfo
-    state.impl = node_module.Node()
+  def start_node(self, state, hostinfo):
+    # load the node's protocol module and construct its Node
+    state.module = self.module_for_host(hostinfo)
+    state.shared_module = (not self.isolate_nodes
+      and getattr(state.module, 'NEEDS_NODE_GLOBALS', True))
 
-    return state
+    self.current_index = state.nodenumber
+    self.switch_context(state)
+    state.impl = state.module.Node()
+    self.current_index = None
 
   def boot_nodes(self):
     for node in self.nodes:
+      if node.impl is None:
+        continue # simulated by another process, see parallel.py
+
       self.current_index = node.nodenumber
-      node_module.nodeinfo = node.nodeinfo
-      node_module.linkinfo = node.nodeinfo.linkinfo
+      self.switch_context(node)
 
       try:
         node.impl.reboot_node()
       except:
+        self.flush()
         etype, value, tb =  sys.exc_info()
-        print("Error in node {} reboot_node:")
+        print("Error in node {} reboot_node:".format(node.nodenumber))
         traceback.print_exception(etype, value, tb)
 
     self.current_index = None
+    self.booted = True
+
+  def open_stats_csv(self, stats_csv):
+    if stats_csv:
+      self.stats_csv_file = open(stats_csv, 'w', newline='')
+
+      self.stats_csv_write = csv.writer(self.stats_csv_file,
+        quoting=csv.QUOTE_MINIMAL)
+
+      self.stats_csv_write.writerow(STATS_CSV_HEADER)
+    else:
+      self.stats_csv_file = None
+      self.stats_csv_write = None
+
+  # files, threads and compiled code stay behind in a snapshot
+  SNAPSHOT_EXCLUDED = ('node_output', 'trace', 'stats_csv_file',
+    'stats_csv_write', 'module_code')
+
+  def __getstate__(self):
+    state = dict(self.__dict__)
+    for name in self.SNAPSHOT_EXCLUDED:
+      state[name] = None
+    state['module_code'] = {}
+    state['random_state'] = random.getstate()
+    return state
+
+  def __setstate__(self, state):
+    random.setstate(state.pop('random_state'))
+    self.__dict__.update(state)
+
+  def snapshot(self, path):
+    if self.current_index != None:
+      raise RuntimeError('cannot snapshot from inside a node handler')
+
+    if not self.booted:
+      self.boot_nodes()
+
+    self.flush()
+
+    node_modules = {}
+    for node in self.nodes:
+      node_modules[id(node.module)] = (node.module, self.isolate_nodes)
+
+    save_snapshot(self, path, list(node_modules.values()))
+
+  @classmethod
+  def from_snapshot(cls, path, node_output=sys.stdout, silent_nodes=False,
+      output_buffer_size=None, output_thread=False, stats_csv=None, trace=None,
+      record_channel=None, metrics=None, link_stats=None, node_stats=None):
+    check_metrics_path(metrics)
+    simulator = load_snapshot(path)
+
+    if silent_nodes and not simulator.silent_nodes:
+      simulator.silent_nodes = True
+      for node in simulator.nodes:
+        simulator.install_api(node.module)
+
+    if not simulator.silent_nodes:
+      simulator.node_output = BufferedOutput(node_output, output_buffer_size,
+        output_thread)
+
+    if trace:
+      simulator.trace = TraceWriter(trace)
+
+    # a recording carries on only if it is saved somewhere new
+    simulator.record_channel = record_channel
+    if not record_channel:
+      simulator.recording = None
+
+    simulator.open_stats_csv(stats_csv)
+    simulator.metrics_path = metrics
+    simulator.link_stats_path = link_stats
+    simulator.node_stats_path = node_stats
+
+    simulator.schedule_stats_period()
+    return simulator
+
+  def schedule_stats_period(self):
+    # once anything wants the periodic stats, and they are not already due
+    if not (self.stats_csv_write or self.metrics_path or self.steady):
+      return
+
+    if not any([entry[4] == STATS_PERIOD for entry in self.event_queue]):
+      self.schedule(self.current_time_usec + self.stats_period, STATS_PERIOD,
+        None)
+
+  def track_steady_state(self, precision, metrics=STEADY_METRICS,
+      confidence=0.95, warmup=None):
+    # from now on, e.g. after from_snapshot(); warmup is counted from 0
+    if warmup is not None:
+      warmup = usecs_from_time(warmup, 'steady state warm-up')
+
+    self.steady = SteadyStateMonitor(float(precision), metrics, confidence,
+      warmup)
+    self.steady.start(self)
+    self.schedule_stats_period()
+
+  def set_parameter(self, name, value, node=None, link=None):
+    # set a link parameter on every WAN link, every link of the node named
+    # node, or link number link of that node; or the messagerate of every
+    # node or just the one named. Loss and corruption, in either form,
+    # reach the link's channel model too (see set_channel_parameter())
+    nodes = self.nodes
+    if node is not None:
+      nodes = [state for state in self.nodes if state.nodeinfo.name == node]
+      if not nodes:
+        raise RuntimeError('unknown node {}'.format(node))
+
+    if name == 'messagerate':
+      # a message already scheduled keeps its time; later gaps use the rate
+      for state in nodes:
+        state.messagerate = usecs_from_time(value, 'messagerate')
+      return
+
+    value = link_parameter(name, value)
+
+    for state in nodes:
+      for linkno, linkinfo in enumerate(state.linkinfos):
+        if link is not None and linkno != int(link):
+          continue
+        if link is None and linkinfo.linktype != LinkType.WAN:
+          continue
+
+        if name in CHANNEL_PROBABILITIES:
+          self.set_channel_parameter(state, linkno, name, value)
+        else:
+          setattr(linkinfo, name, value)
+          if name in ('probframeloss', 'probframecorrupt'):
+            self.set_channel_parameter(state, linkno, name, value)
+
+  def set_channel_parameter(self, state, linkno, name, value):
+    # rebuilds the channel of a link direction from its keys with name
+    # changed, on the same seed; legacy channels read probframeloss and
+    # probframecorrupt from the linkinfo, so are left alone
+    key = (state.nodeinfo.nodenumber, linkno)
+    if not key in self.channel_specs:
+      raise RuntimeError('{} link {} has no channel to set {} on'.format(
+        state.nodeinfo.name, linkno, name))
+
+    spec, seed, what, rng = self.channel_specs[key]
+    linkinfo = state.linkinfos[linkno]
+
+    if name in dict(PROBABILITY_KEYS):
+      if not spec:
+        return
+      probability = dict(PROBABILITY_KEYS)[name]
+      spec = dict(spec)
+      spec.pop(probability, None) # folded again from the new value
+    else:
+      spec = dict(spec)
+      spec[name] = value
+
+    if 'channel' in spec:
+      raise RuntimeError('cannot set {} on {}, which uses its own channel model'.format(
+        name, what))
+
+    fold_probabilities(spec, linkinfo)
+    linkinfo.channel = build_channel(spec, linkinfo, seed, what, rng)
+    self.channel_specs[key] = (spec, seed, what, rng)
+
+  # run until duration (usecs or a time string) or until no events remain,
+  # returning the final counters
+  def run(self, duration=None):
+    self.duration_usec = usecs_from_time(duration, 'execution duration')
+
+    if not self.booted:
+      self.boot_nodes()
+
+    if self.metrics_path and self.duration_usec:
+      self.metrics.reserve(self.duration_usec // self.stats_period + 2)
+
+    try:
+      while True:
+        if not self.process_next_event():
+          break
+    finally:
+      if self.metrics_path:
+        self.metrics.record_interval(self) # the last, possibly partial, one
+      self.flush()
+
+    return self.counters()
+
+  def flush(self):
+    if self.node_output:
+      self.node_output.flush()
+    if self.trace:
+      self.trace.flush()
+    if self.stats_csv_file:
+      self.stats_csv_file.flush()
+
+  def close(self):
+    if self.metrics_path:
+      self.metrics.save(self.metrics_path)
+      self.metrics_path = None
+    if self.link_stats_path:
+      self.write_link_stats(self.link_stats_path)
+      self.link_stats_path = None
+    if self.node_stats_path:
+      self.write_node_stats(self.node_stats_path)
+      self.node_stats_path = None
+    if self.recording:
+      self.recording.save(self.record_channel)
+      self.recording = None
+    if self.trace:
+      self.trace.close()
+      self.trace = None
+    if self.node_output:
+      self.node_output.close()
+      self.node_output = None
+    if self.stats_csv_file:
+      self.stats_csv_file.close()
+      self.stats_csv_file = None
+      self.stats_csv_write = None
+
+  def counters(self):
+    average_delivery_time = 0
+
+    if self.messages_delivered:
+      average_delivery_time = self.total_delivery_time // self.messages_delivered
+
+    efficiency = 1
+    if self.bytes_received_physical:
+      efficiency = self.bytes_received_application / self.bytes_received_physical
+
+    counters = {
+      'time_usec': self.current_time_usec,
+      'events_raised': self.events_raised,
+      'messages_generated': self.messages_generated,
+      'messages_delivered': self.messages_delivered,
+      'average_delivery_time': average_delivery_time,
+      'frames_transmitted': self.frames_transmitted,
+      'frames_received': self.frames_received,
+      'frames_dropped': self.frames_dropped,
+      'bytes_received_physical': self.bytes_received_physical,
+      'bytes_received_application': self.bytes_received_application,
+      'efficiency': efficiency,
+      'timers_live': len(self.timers),
+      'timers_cancelled': self.timers.timers_cancelled,
+      **self.metrics.percentiles()
+    }
+
+    if self.steady:
+      counters.update(self.steady.summary())
+
+    return counters
+
+  def link_counters(self):
+    # one dict per direction of every link, as seen by its sending node
+    counters = []
+    elapsed = self.current_time_usec
+
+    for node in self.nodes:
+      for linkno, (link, stats) in enumerate(zip(node.links, node.linkstats)):
+        counters.append({
+          'node': node.nodeinfo.name,
+          'link': linkno,
+          'to': [self.nodes[peer.nodenumber].nodeinfo.name
+            for peer, port in link.get_destinations(node)],
+          'frames_sent': stats.frames_sent,
+          'bytes_sent': stats.bytes_sent,
+          'frames_lost': stats.frames_lost,
+          'frames_corrupted': stats.frames_corrupted,
+          'frames_dropped': stats.frames_dropped,
+          'frames_delivered': stats.frames_delivered,
+          'bytes_delivered': stats.bytes_delivered,
+          'busy_usec': stats.busy_usec,
+          'utilisation': stats.busy_usec / elapsed if elapsed else 0,
+          'queue_usec': stats.queue_usec,
+          'queued': len(node.transmitters[linkno].queue or ()),
+          'peak_queued': stats.peak_queued,
+          'in_flight': stats.in_flight,
+          'peak_in_flight': stats.peak_in_flight
+        })
+
+    return counters
+
+  def node_counters(self):
+    counters = []
+
+    for node in self.nodes:
+      counters.append({
+        'node': node.nodeinfo.name,
+        'frames_sent': sum([stats.frames_sent for stats in node.linkstats]),
+        'bytes_sent': sum([stats.bytes_sent for stats in node.linkstats]),
+        'frames_received': node.frames_received,
+        'bytes_received': node.bytes_received,
+        'messages_generated': node.messages_generated,
+        'messages_delivered': node.messages_delivered,
+        'bytes_delivered': node.bytes_delivered
+      })
+
+    return counters
+
+  def write_link_stats(self, path):
+    with open(path, 'w', newline='') as fout:
+      writer = csv.writer(fout, quoting=csv.QUOTE_MINIMAL)
+      writer.writerow(LINK_STATS_CSV_HEADER)
+      for c in self.link_counters():
+        writer.writerow([c['node'], c['link'], ' '.join(c['to']),
+          c['frames_sent'], c['bytes_sent'], c['frames_lost'],
+          c['frames_corrupted'], c['frames_dropped'], c['frames_delivered'],
+          c['bytes_delivered'], c['busy_usec'], c['utilisation'],
+          c['queue_usec'], c['queued'], c['peak_queued'], c['in_flight'],
+          c['peak_in_flight']])
+
+  def write_node_stats(self, path):
+    with open(path, 'w', newline='') as fout:
+      writer = csv.writer(fout, quoting=csv.QUOTE_MINIMAL)
+      writer.writerow(NODE_STATS_CSV_HEADER)
+      for c in self.node_counters():
+        writer.writerow([c['node'], c['frames_sent'], c['bytes_sent'],
+          c['frames_received'], c['bytes_received'], c['messages_generated'],
+          c['messages_delivered'], c['bytes_delivered']])
+
+  def stats_totals(self):
+    return [self.current_time_usec, self.events_raised,
+      self.messages_generated, self.messages_delivered,
+      self.total_delivery_time, self.frames_transmitted, self.frames_received,
+      self.bytes_received_physical, self.bytes_received_application]
+
+  def write_stats_row(self):
+    self.stats_csv_write.writerow(stats_csv_row(*self.stats_totals()))
+
+  def switch_context(self, node):
+    node.module.nodeinfo = node.nodeinfo
+    node.module.linkinfo = node.nodeinfo.linkinfo
 
   def call_node_handler(self, node_index, event, *args):
     if self.current_index != None:
       raise RuntimeError('recursive call_node_handler')
-    
+
     node = self.nodes[node_index]
-    handlers = node.handlers
+    handler = node.handlers.get(event)
 
-    if event in handlers:
-      self.current_index = node_index
-      node_module.nodeinfo = node.nodeinfo
-      node_module.linkinfo = node.nodeinfo.linkinfo
+    if handler is None:
+      return
 
-      try:
-        # sig = inspect.signature(handlers[event])
-        # args = args[:len(sig.parameters)]
-        passedargs = args[:node.handler_num_args[event]]
-        handlers[event](*passedargs)
-      except:
-        etype, value, tb = sys.exc_info()
-        print("Error in node {} handler {}:")
-        traceback.print_exception(etype, value, tb)
-        exit(1)
-      
-      self.current_index = None
+    if node.shared_module and node.module.nodeinfo is not node.nodeinfo:
+      self.switch_context(node)
 
-  def next_application_message(self):
-    earliest = None
+    self.current_index = node_index
 
-    for node in self.nodes_with_application_enabled:
-      if (node.next_message_usec < self.current_time_usec):
-        node.next_message_usec = self.current_time_usec + poisson_usecs(node.messagerate)
-      if (earliest == None or node.next_message_usec < earliest.next_message_usec):
-        earliest = node
+    try:
+      handler(*args)
+    except:
+      self.current_index = None
+      self.flush()
+      etype, value, tb = sys.exc_info()
+      print("Error in node {} handler {}:".format(node_index, event))
+      traceback.print_exception(etype, value, tb)
+      raise RuntimeError('node {} failed in handler {}'.format(node_index,
+        event))
+
+    self.current_index = None
 
-    if earliest != None:
-      return (earliest.next_message_usec, earliest)
+  # Events at the same time run in the order they were scheduled in, then by
+  # the number of the node they were scheduled for (-1 for the simulator's
+  # own) and that node's count of events scheduled. Nothing in that order
+  # depends on what other nodes are doing, so a node sees the same sequence
+  # of events however the nodes are split between processes (parallel.py).
+  # Timers are due before anything else at their time, in the order they
+  # were started, see schedule_timer().
+  def schedule(self, time, kind, item, origin=None):
+    if origin is None:
+      self.events_scheduled = self.events_scheduled + 1
+      heapq.heappush(self.event_queue, (time, self.current_time_usec, -1,
+        self.events_scheduled, kind, item))
     else:
-      return (None, None)
+      origin.events_scheduled = origin.events_scheduled + 1
+      heapq.heappush(self.event_queue, (time, self.current_time_usec,
+        origin.nodenumber, origin.events_scheduled, kind, item))
+
+  def schedule_timer(self, timer):
+    heapq.heappush(self.event_queue, (timer.timeout, -1, -1, timer.timerid,
+      TIMER_EXPIRY, timer))
+
+  def schedule_application_message(self, node):
+    if node.application_scheduled:
+      return
+
+    if (node.next_message_usec < self.current_time_usec):
+      node.next_message_usec = self.current_time_usec + self.source.message_gap(node)
+
+    node.application_scheduled = True
+    self.schedule(node.next_message_usec, APPLICATION_MESSAGE, node, node)
+
+  def choose_application_destination(self, sender, rng=random):
+    if sender.application_to_all:
+      # same draw as random.choice() over every other node, in order
+      destnum = rng.randrange(len(self.nodes) - 1)
+      if destnum >= sender.nodenumber:
+        destnum = destnum + 1
+      return destnum
+
+    if sender.application_destinations:
+      return rng.choice(sender.application_destinations)
+
+    return None
+
+  def may_send_to(self, sender, destnum):
+    if destnum == sender.nodenumber or destnum < 0 or destnum >= len(self.nodes):
+      return False
+    return (sender.application_to_all
+      or destnum in sender.application_destination_index)
 
   def generate_application_message(self, sender):
-    dests = sender.application_destinations
-    
-    if dests:
-      destnum = random.choice(dests)
-      
-      messagebytes = secrets.token_bytes(50)
-      
-      self.events_raised = self.events_raised + 1
-      simulator.call_node_handler(sender.nodenumber, Event.APPLICATIONREADY,
-        destnum, messagebytes)
-      
-      self.messages_generated = self.messages_generated + 1
+    destnum = self.source.message_destination(sender)
 
-      dest = self.nodes[destnum]
+    if destnum != None:
+      # numbered per sender, so ids do not depend on other nodes' messages
+      msgid = sender.messages_generated * len(self.nodes) + sender.nodenumber + 1
 
-      dest.application_waiting[messagebytes] = self.current_time_usec
+      if self.payloads is None:
+        messagebytes = self.source.message_payload(sender)
+        key = messagebytes
+      else:
+        messagebytes = self.payloads.make(msgid, self.current_time_usec)
+        key = msgid
 
-      sender.next_message_usec = 0 # will be regenerated by next_application_message
+      sender.next_message_usec = -1 # drawn again once this one is handled
 
-  def process_next_event(self):
-    app_time, app_node = self.next_application_message()
+      if self.trace:
+        self.trace.record(self.current_time_usec,
+          TraceKind.APPLICATION_MESSAGE, 0, -1, sender.nodenumber, destnum,
+          msgid, len(messagebytes))
 
-    event_time = None
-    if self.event_queue:
-      event_time, event = self.event_queue[0]
+      self.events_raised = self.events_raised + 1
+      self.call_node_handler(sender.nodenumber, Event.APPLICATIONREADY,
+        destnum, messagebytes)
+
+      self.messages_generated = self.messages_generated + 1
+      sender.messages_generated = sender.messages_generated + 1
 
-    timer_time = None
-    if self.timer_queue:
-      timer_time = self.timer_queue[0].timeout
+      dest = self.nodes[destnum]
 
-    earliest_time = earliest([app_time, event_time, timer_time,
-      self.next_stats_print_usec])
+      dest.application_waiting[key] = self.current_time_usec
 
-    if earliest_time == None:
+  def process_next_event(self):
+    if not self.event_queue:
       return False
 
-    if self.duration_usec and earliest_time > self.duration_usec:
+    time = self.event_queue[0][0]
+
+    if self.duration_usec and time > self.duration_usec:
       self.current_time_usec = self.duration_usec
       return False
 
-    if earliest_time < self.current_time_usec:
+    if time < self.current_time_usec:
       raise RuntimeError('time is running backwards?')
 
-    self.current_time_usec = earliest_time
+    entry = heapq.heappop(self.event_queue)
+    time, scheduled, origin, seq, kind, item = entry
+    self.current_time_usec = time
+    self.current_event = entry
 
-    if earliest_time == app_time:
-      self.generate_application_message(app_node)
-      return True
+    if kind == FRAME_DELIVERY:
+      for receiver, linkno in item.receivers:
+        if self.trace:
+          self.trace.record(time, TraceKind.FRAME_DELIVERY, 0, linkno,
+            receiver.nodenumber, item.sender, item.number, len(item.frame))
 
-    if earliest_time == event_time:
-      event_time, event = heapq.heappop(self.event_queue)
-      if (isinstance(event, FrameDelivery)):
-        for receiver in event.receivers:
-          try:
-            linkno = receiver.links.index(event.link)
-          except:
-            raise RuntimeError('receiving node does not have link?')
-
-          self.events_raised = self.events_raised + 1
-          self.frames_received = self.frames_received + 1
-          self.bytes_received_physical = self.bytes_received_physical + len(event.frame)
-          self.call_node_handler(receiver.nodenumber, Event.PHYSICALREADY, linkno, event.frame)
-      else:
-        raise RuntimeError('unexpected event type {}'.format(event))
-      return True
-    
-    if earliest_time == timer_time:
-      timer = heapq.heappop(self.timer_queue)
-      if not timer.cancelled:
         self.events_raised = self.events_raised + 1
-        self.call_node_handler(timer.nodenumber, timer.event, timer.timerid)
-        try:
-          self.timer_map.pop(timer.timerid)
-        except:
-          pass
-      return True
-    
-    if earliest_time == self.next_stats_print_usec:
+        self.frames_received = self.frames_received + 1
+        self.bytes_received_physical = self.bytes_received_physical + len(item.frame)
+        receiver.frames_received = receiver.frames_received + 1
+        receiver.bytes_received = receiver.bytes_received + len(item.frame)
+        stats = item.stats
+        stats.frames_delivered = stats.frames_delivered + 1
+        stats.bytes_delivered = stats.bytes_delivered + len(item.frame)
+        self.call_node_handler(receiver.nodenumber, Event.PHYSICALREADY, linkno, item.frame)
+
+      item.stats.in_flight = item.stats.in_flight - 1
+      item.frame = None
+      item.receivers = None
+      self.free_deliveries.append(item)
+
+    elif kind == TIMER_EXPIRY:
+      # entries of stopped timers are skipped here
+      if not item.cancelled:
+        if self.trace:
+          self.trace.record(time, TraceKind.TIMER_FIRE, 0,
+            item.event.value, item.nodenumber, -1, item.timerid, 0)
+
+        self.events_raised = self.events_raised + 1
+        self.call_node_handler(item.nodenumber, item.event, item.timerid)
+        self.timers.finished(item)
+
+      self.timers.release(item)
+
+    elif kind == APPLICATION_MESSAGE:
+      # entries for nodes whose application has since been disabled are
+      # simply dropped here
+      item.application_scheduled = False
+      if item.application_enabled:
+        self.generate_application_message(item)
+        if item.application_enabled:
+          self.schedule_application_message(item)
+
+    elif kind == TRANSMITTER_READY:
+      item.wakeup_pending = False
+      self.start_transmission(item, *item.queue.popleft())
+      if item.queue:
+        item.wakeup_pending = True
+        self.schedule(item.busy_until, TRANSMITTER_READY, item, item.node)
+
+    elif kind == STATS_PERIOD:
       if self.stats_csv_write:
-        average_delivery_time = 0
-
-        if self.messages_delivered:
-          average_delivery_time = self.total_delivery_time // self.messages_delivered
-
-        efficiency = 1
-        if self.bytes_received_physical:
-          efficiency = self.bytes_received_application / self.bytes_received_physical
-
-        self.stats_csv_write.writerow([self.current_time_usec,
-          self.events_raised,
-          self.messages_generated, self.messages_delivered,
-          average_delivery_time,
-          self.frames_transmitted, self.frames_received,
-          self.bytes_received_physical, self.bytes_received_application,
-          efficiency])
-        
-        self.next_stats_print_usec = self.next_stats_print_usec + self.stats_period
-      else:
-        self.next_stats_print_usec = None
+        self.write_stats_row()
+      if self.metrics_path:
+        self.metrics.record_interval(self)
 
-      return True
-    
-    return False
+      self.schedule(time + self.stats_period, STATS_PERIOD, None)
 
-  # this function also adapted from the cnet network simulator (see copyright
-  # notice above)
-  def corrupt_frame(self, linkinfo, frame):
-    prob = probframecorrupt
-    if linkinfo.probframecorrupt != None:
-      prob = linkinfo.probframecorrupt
+      if self.steady and self.steady.record(self):
+        return False # the estimates are precise enough
 
-    if (prob > 0 and random.randrange(0, prob) == 0):
-      # CORRUPT FRAME BY COMPLEMENTING TWO OF ITS BYTES
-      offset = random.randrange(0, len(frame) - 2)
-      frame = bytearray(frame)
-      frame[offset] = (~frame[offset] & 0xFF) # detectable by all checksums
-      frame[offset + 1] = (~frame[offset + 1] & 0xFF)
-      frame = bytes(frame)
+    else:
+      raise RuntimeError('unexpected event type {}'.format(kind))
 
-    return frame
+    return True
+
+  # this function also adapted from the cnet network simulator (see copyright
+  # notice above)
+  def corrupt_frame(self, frame, offset):
+    # CORRUPT FRAME BY COMPLEMENTING TWO OF ITS BYTES
+    # detectable by all checksums; the corrupted copy is the only one made
+    view = memoryview(frame)
+    return b''.join((view[:offset],
+      bytes((~frame[offset] & 0xFF, ~frame[offset + 1] & 0xFF)),
+      view[offset + 2:]))
 
   # standard functions that are redirected from the node perspective
 
   def intercepted_print(self, *userargs):
-    if not args.silent_nodes:
-      print('[{}]: '.format(self.current_index), *userargs,
-        file=args.node_output)
-  
+    self.node_output.write(' '.join(['[{}]: '.format(self.current_index)]
+      + [str(x) for x in userargs]) + '\n')
+
+  def node_log(self, level, message, *args):
+    if level < self.log_level:
+      return
+
+    if args:
+      message = message.format(*args)
+
+    self.node_output.write('[{}]:  {}\n'.format(self.current_index, message))
+
   # below here is node-facing functionality
 
   def enable_application(self, nodenumber = None):
+    current_node = self.nodes[self.current_index]
+
     if (nodenumber == None):
-      for nn in range(len(self.nodes)):
-        self.enable_application(nn)
+      if len(self.nodes) > 1:
+        current_node.application_to_all = True
+        current_node.application_enabled = True
+        self.schedule_application_message(current_node)
       return True
     else:
       if nodenumber < 0 or nodenumber >= len(self.nodes):
         return False
-      
+
       if self.current_index != nodenumber:
-        current_node = self.nodes[self.current_index]
-        if not (nodenumber in current_node.application_destinations):
-          current_node.application_destinations.append(nodenumber)
-          current_node.application_enabled = True
-          self.nodes_with_application_enabled = [x for x in self.nodes if x.application_enabled]
-  
+        if not current_node.application_to_all:
+          current_node.add_application_destination(nodenumber)
+        current_node.application_enabled = True
+        self.schedule_application_message(current_node)
+      return True
+
   def disable_application(self, nodenumber = None):
+    current_node = self.nodes[self.current_index]
+
     if (nodenumber == None):
-      for nn in range(len(self.nodes)):
-        self.disable_application(nn)
+      current_node.application_to_all = False
+      current_node.application_destinations = []
+      current_node.application_destination_index = {}
+      current_node.application_enabled = False
       return True
     else:
       if nodenumber < 0 or nodenumber >= len(self.nodes):
         return False
-      
+
       if self.current_index != nodenumber:
-        current_node = self.nodes[self.current_index]
-        current_node.application_destinations.remove(nodenumber)
+        if current_node.application_to_all:
+          # only now do the other destinations need to be listed one by one
+          current_node.application_to_all = False
+          for nn in range(len(self.nodes)):
+            if nn != self.current_index:
+              current_node.add_application_destination(nn)
+
+        current_node.remove_application_destination(nodenumber)
         if not current_node.application_destinations:
           current_node.application_enabled = False
-          self.nodes_with_application_enabled = [x for x in self.nodes if x.application_enabled]
+      return True
 
   def start_timer(self, event, usecs, data = None):
     if usecs < 0:
@@ -591,181 +1315,404 @@ class Simulator:
 
     self.timers_created = self.timers_created + 1
     timeout = self.current_time_usec + usecs
-    timer = Timer(timeout, self.timers_created, self.current_index, event, data)
-    heapq.heappush(self.timer_queue, timer)
-    self.timer_map[self.timers_created] = timer
+    timer = self.timers.start(timeout, self.timers_created, self.current_index,
+      event, data)
+
+    if self.trace:
+      self.trace.record(self.current_time_usec, TraceKind.TIMER_START, 0,
+        event.value, self.current_index, -1, self.timers_created, usecs)
+
+    self.schedule_timer(timer)
     return self.timers_created
 
   def stop_timer(self, timerid):
-    try:
-      timer = self.timer_map.pop(timerid)
-      timer.cancelled = True
-      return True
-    except:
+    if self.trace:
+      timer = self.timers.get(timerid)
+      if timer is not None:
+        self.trace.record(self.current_time_usec, TraceKind.TIMER_CANCEL, 0,
+          timer.event.value, timer.nodenumber, -1, timerid,
+          timer.timeout - self.current_time_usec)
+
+    if not self.timers.cancel(timerid):
       return False
 
+    if self.timers.needs_compacting(self.event_queue):
+      self.timers.compact(self.event_queue, TIMER_EXPIRY)
+    return True
+
   def timer_data(self, timerid):
-    try:
-      timer = self.timer_map[timerid]
-      return timer.data
-    except:
+    timer = self.timers.get(timerid)
+    if timer is None:
       raise RuntimeError('timer no longer exists')
+    return timer.data
 
   def set_handler(self, event, callback):
     # print('{}: {} -> {}'.format(self.current_index, event, callback))
-    sig = inspect.signature(callback)
-    numargs = len(sig.parameters)
     node = self.nodes[self.current_index]
-    node.handlers[event] = callback
-    node.handler_num_args[event] = numargs
-  
+    node.handlers[event] = adapt_handler(callback, event)
+
   def write_physical(self, linkno, frame):
     sender = self.nodes[self.current_index]
 
     if (linkno < 0 or linkno >= len(sender.links)):
       return False
-    
+
     if not isinstance(frame, bytes):
       raise TypeError('frame *must* be a bytes object')
-    
-    link = sender.links[linkno]
+
     linkinfo = sender.linkinfos[linkno]
-    # print('{} transmit {} bytes on link {}'.format(self.current_index, len(frame), link))
+    # print('{} transmit {} bytes on link {}'.format(self.current_index, len(frame), linkno))
 
     if (not linkinfo.linkup):
       return False
 
-    self.frames_transmitted = self.frames_transmitted + 1
+    stats = sender.linkstats[linkno]
+    transmitter = sender.transmitters[linkno]
+    queue = transmitter.queue
+    idle = not queue and transmitter.busy_until <= self.current_time_usec
 
-    # lose frame
-    probloss = probframeloss
-    if linkinfo.probframeloss != None:
-      probloss = linkinfo.probframeloss
-    
-    if probloss and random.randrange(0, probloss) == 0:
-      return True
+    if not idle and queue is None:
+      queue = transmitter.queue = deque()
 
-    frame = self.corrupt_frame(linkinfo, frame)
+    if not idle and linkinfo.txqueuelength is not None \
+        and len(queue) >= linkinfo.txqueuelength:
+      if linkinfo.txqueuepolicy == QueuePolicy.DROPTAIL or not queue:
+        self.drop_frame(sender, linkno, len(frame))
+        return False
 
-    receivers = link.get_destination_nodes(sender)
+      dropped, transmission_usec, queued = queue.popleft()
+      self.drop_frame(sender, linkno, len(dropped))
 
-    if (len(receivers) > 0):
-      time = self.current_time_usec
+    transmission_usec = 0
+    if (linkinfo.bandwidth > 0):
+      transmission_usec = len(frame) * 8 * TIME_SUFFIX_TO_USEC['s'] // linkinfo.bandwidth
 
-      bandwidth = linkinfo.bandwidth
-      if (bandwidth > 0):
-        time = time + (len(frame) * 8 * TIME_SUFFIX_TO_USEC['s'] // bandwidth)
-      
-      if (linkinfo.propagationdelay > 0):
-        time = time + linkinfo.propagationdelay
+    if idle:
+      self.start_transmission(transmitter, frame, transmission_usec,
+        self.current_time_usec)
+    else:
+      queue.append((frame, transmission_usec, self.current_time_usec))
+      if len(queue) > stats.peak_queued:
+        stats.peak_queued = len(queue)
 
-      heapq.heappush(self.event_queue, (time, FrameDelivery(frame, link, receivers)))
+      if not transmitter.wakeup_pending:
+        transmitter.wakeup_pending = True
+        self.schedule(transmitter.busy_until, TRANSMITTER_READY, transmitter,
+          sender)
 
     return True
-  
+
+  def start_transmission(self, transmitter, frame, transmission_usec, queued):
+    sender = transmitter.node
+    linkno = transmitter.linkno
+    link = sender.links[linkno]
+    stats = transmitter.stats
+
+    self.frames_transmitted = self.frames_transmitted + 1
+
+    stats.frames_sent = stats.frames_sent + 1
+    stats.bytes_sent = stats.bytes_sent + len(frame)
+
+    lost, offset = self.source.frame_fate(sender, linkno, len(frame))
+
+    if self.trace:
+      flags = 0
+      if lost:
+        flags = TRACE_LOST
+      elif offset != None:
+        flags = TRACE_CORRUPTED
+      self.trace.record(self.current_time_usec, TraceKind.WRITE_PHYSICAL,
+        flags, linkno, sender.nodenumber, -1, self.frames_transmitted,
+        len(frame))
+
+    # a lost frame still holds the link while it is sent
+    receivers = None
+    if lost:
+      stats.frames_lost = stats.frames_lost + 1
+    else:
+      receivers = link.get_destinations(sender)
+
+    if offset != None and not lost:
+      stats.frames_corrupted = stats.frames_corrupted + 1
+      frame = self.corrupt_frame(frame, offset)
+
+    now = self.current_time_usec
+    stats.busy_usec = stats.busy_usec + transmission_usec
+    stats.queue_usec = stats.queue_usec + now - queued
+    transmitter.busy_until = now + transmission_usec
+
+    if receivers:
+      if self.free_deliveries:
+        delivery = self.free_deliveries.pop()
+        delivery.frame = frame
+        delivery.link = link
+        delivery.receivers = receivers
+        delivery.sender = sender.nodenumber
+        delivery.number = self.frames_transmitted
+        delivery.stats = stats
+      else:
+        delivery = FrameDelivery(frame, link, receivers, sender.nodenumber,
+          self.frames_transmitted, stats)
+
+      time = transmitter.busy_until
+      if (transmitter.linkinfo.propagationdelay > 0):
+        time = time + transmitter.linkinfo.propagationdelay
+
+      self.schedule_delivery(transmitter, delivery, time)
+
+  def schedule_delivery(self, transmitter, delivery, time):
+    stats = transmitter.stats
+    stats.in_flight = stats.in_flight + 1
+    if stats.in_flight > stats.peak_in_flight:
+      stats.peak_in_flight = stats.in_flight
+
+    self.schedule(time, FRAME_DELIVERY, delivery, transmitter.node)
+
+  def drop_frame(self, sender, linkno, length):
+    # a frame refused by, or pushed out of, a full transmit queue; it never
+    # reached the link, so has no number
+    stats = sender.linkstats[linkno]
+    stats.frames_dropped = stats.frames_dropped + 1
+    self.frames_dropped = self.frames_dropped + 1
+
+    if self.trace:
+      self.trace.record(self.current_time_usec, TraceKind.WRITE_PHYSICAL,
+        TRACE_DROPPED, linkno, sender.nodenumber, -1, -1, length)
+
   def write_application(self, message):
     node = self.nodes[self.current_index]
 
     if not isinstance(message, bytes):
       raise TypeError('write_application must receive a bytes() object')
 
-    try:
-      sent_time = node.application_waiting.pop(message)
-    except:
+    key = message
+    msgid = -1
+    if self.payloads is not None:
+      key = self.payloads.message_id(message)
+      if key is not None:
+        msgid = key
+
+    sent_time = node.application_waiting.get(key)
+
+    if sent_time is not None and self.payloads is not None \
+        and self.payloads.timestamps \
+        and self.payloads.timestamp(message) != sent_time:
+      sent_time = None # corrupted in the timestamp
+
+    if sent_time is None:
+      if self.trace:
+        self.trace.record(self.current_time_usec, TraceKind.WRITE_APPLICATION,
+          TRACE_REJECTED, -1, node.nodenumber, -1, msgid, len(message))
       return False
-    
+
+    del node.application_waiting[key]
     elapsed = self.current_time_usec - sent_time
 
+    if self.trace:
+      self.trace.record(self.current_time_usec, TraceKind.WRITE_APPLICATION, 0,
+        -1, node.nodenumber, -1, msgid, elapsed)
+
     self.total_delivery_time = self.total_delivery_time + elapsed
+    self.metrics.latency.record(elapsed)
     self.messages_delivered = self.messages_delivered + 1
     self.bytes_received_application = self.bytes_received_application + len(message)
+    node.messages_delivered = node.messages_delivered + 1
+    node.bytes_delivered = node.bytes_delivered + len(message)
 
     return True
 
 
-if args.seed:
-  random.seed(args.seed)
+def build_parser():
+  parser = argparse.ArgumentParser(prog='Network Simulator')
 
-simulator = Simulator()
+  parser.add_argument('-e', '--execution-duration', nargs='?')
 
-bandwidth = 56 * 1024
+  parser.add_argument('--node-output', nargs='?', type=argparse.FileType('w'),
+    default=sys.stdout)
 
-if 'bandwidth' in topology and topology['bandwidth']:
-  try:
-    bandwidth = bps_from_bandwidth_str(topology['bandwidth'])
-  except:
-    print('failed to set bandwidth={}'.format(topology['bandwidth']))
-    exit(1)
+  parser.add_argument('--silent-nodes', action='store_true')
+
+  parser.add_argument('--node-log-level', default='info',
+    choices=[level.name.lower() for level in LogLevel])
+
+  parser.add_argument('--node-output-thread', action='store_true')
+
+  parser.add_argument('--stats-period', nargs='?')
+
+  parser.add_argument('--stats-csv', nargs='?')
+
+  parser.add_argument('--metrics', nargs='?')
 
-propagationdelay = 2500 * 1000
+  parser.add_argument('--link-stats', nargs='?')
+
+  parser.add_argument('--node-stats', nargs='?')
+
+  parser.add_argument('-S', '--seed', nargs='?', type=int)
+
+  parser.add_argument('--rng', default='streams', choices=RNG_MODES)
+
+  parser.add_argument('--payload', default='compact', choices=PAYLOAD_MODES)
+
+  parser.add_argument('--payload-size', type=int, default=DEFAULT_PAYLOAD_SIZE)
+
+  parser.add_argument('--payload-timestamps', action='store_true')
+
+  parser.add_argument('--shared-modules', action='store_true')
+
+  parser.add_argument('--trace', nargs='?')
+
+  parser.add_argument('--record-channel', nargs='?')
+
+  parser.add_argument('--replay-channel', nargs='?')
+
+  parser.add_argument('--precision', nargs='?', type=float)
+
+  parser.add_argument('--confidence', type=float, default=0.95)
+
+  parser.add_argument('--steady-metric', action='append', choices=STEADY_METRICS)
+
+  parser.add_argument('--steady-warmup', nargs='?')
+
+  parser.add_argument('--snapshot', nargs='?')
+
+  parser.add_argument('--resume', nargs='?')
+
+  parser.add_argument('--set', action='append', type=parse_setting,
+    default=[])
+
+  parser.add_argument('--partitions', nargs='?', type=int)
+
+  parser.add_argument('topology', nargs='?')
+
+  return parser
+
+
+def parse_setting(s):
+  # [NODE[:LINK]:]NAME=VALUE
+  if not '=' in s:
+    raise argparse.ArgumentTypeError('expected [node[:link]:]name=value, got {}'.format(s))
+
+  target, value = s.split('=', 1)
+  parts = target.split(':')
+
+  if len(parts) > 3:
+    raise argparse.ArgumentTypeError('expected [node[:link]:]name=value, got {}'.format(s))
+
+  node = parts[0] if len(parts) > 1 else None
+  link = parts[1] if len(parts) > 2 else None
+  return (parts[-1], value, node, link)
+
+
+def main(argv=None):
+  parser = build_parser()
+  args = parser.parse_args(argv)
+
+  if (args.topology is None) == (args.resume is None):
+    parser.error('give either a topology or --resume')
+
+  simulator = None
 
-if 'propagationdelay' in topology and topology['propagationdelay']:
   try:
-    propagationdelay = usecs_from_time_str(topology['propagationdelay'])
-  except:
-    print('failed to set propagationdelay={}'.format(topology['propagationdelay']))
+    try:
+      if args.resume:
+        simulator = Simulator.from_snapshot(args.resume,
+          node_output=args.node_output, silent_nodes=args.silent_nodes,
+          output_thread=args.node_output_thread,
+          stats_csv=args.stats_csv, trace=args.trace,
+          record_channel=args.record_channel, metrics=args.metrics,
+          link_stats=args.link_stats, node_stats=args.node_stats)
+      elif args.partitions:
+        simulator = new_partitioned_simulator(args)
+      else:
+        simulator = new_simulator(args)
+
+      for name, value, node, link in args.set:
+        simulator.set_parameter(name, value, node, link)
+
+      counters = simulator.run(args.execution_duration)
+
+      if simulator.steady:
+        print_steady_state(counters, simulator.steady)
+
+      if args.snapshot:
+        simulator.snapshot(args.snapshot)
+    finally:
+      # outputs are written and closed on the error path too
+      if simulator is not None:
+        simulator.close()
+  except RuntimeError as e:
+    print(e)
     exit(1)
 
-if 'hosts' in topology:
-  hostlookup = {}
-  linklookup = {}
-  hostnum = 0
-
-  # first just create the nodes
-  for host in topology['hosts']:
-    hostnum = hostnum + 1
-    
-    if not 'name' in host:
-      host['name'] = 'Host {}'.format(hostnum)
-    
-    hostlookup[host['name']] = simulator.add_node(host)
-
-  # now go back through and create the links
-  for host in topology['hosts']:
-    if 'links' in host:
-      for link in host['links']:
-        if 'to' in link:
-          if link['to'] in hostlookup:
-            node1 = hostlookup[host['name']]
-            linkid = [host['name'], link['to']].sort()
-            
-            if linkid in linklookup:
-              wan, linkinfo2, linkinfo1 = linklookup[linkid]
-            else:
-              node2 = hostlookup[link['to']]
-              wan = LinkWAN()
-              linkinfo1 = LinkInfo(LinkType.WAN, bandwidth, propagationdelay, probframeloss, probframecorrupt)
-              linkinfo2 = LinkInfo(LinkType.WAN, bandwidth, propagationdelay, probframeloss, probframecorrupt)
-              node1.add_link(wan, linkinfo1)
-              node2.add_link(wan, linkinfo2)
-              linklookup[linkid] = (wan, linkinfo1, linkinfo2)
-            
-            # adjust properties for linkinfo1 only
-            if 'bandwidth' in link and link['bandwidth']:
-              try:
-                linkinfo1.bandwidth = bps_from_bandwidth_str(link['bandwidth'])
-              except:
-                print('failed to set bandwidth={}'.format(link['bandwidth']))
-                exit(1)
-
-            if 'propagationdelay' in link and link['propagationdelay']:
-              try:
-                linkinfo1.propagationdelay = usecs_from_time_str(link['propagationdelay'])
-              except:
-                print('failed to set propagationdelay={}'.format(link['propagationdelay']))
-                exit(1)
-            
-            if 'probframecorrupt' in link:
-              linkinfo1.probframecorrupt = 1 << int(link['probframecorrupt'])
-
-            if 'probframeloss' in link:
-              linkinfo1.probframeloss = 1 << int(link['probframeloss'])
-
-          else:
-            print('unknown node {}'.format(link['to']))
-
-simulator.boot_nodes()
-
-while True:
-  if not simulator.process_next_event():
-    break
+
+def new_simulator(args):
+  # try to parse the topology file and load the user's module
+
+  with open(args.topology, 'r') as fin:
+    topology = json.load(fin)
+
+  return Simulator(topology, node_output=args.node_output,
+    silent_nodes=args.silent_nodes, stats_period=args.stats_period,
+    stats_csv=args.stats_csv, seed=args.seed,
+    isolate_nodes=not args.shared_modules,
+    log_level=LogLevel[args.node_log_level.upper()],
+    output_thread=args.node_output_thread, trace=args.trace,
+    record_channel=args.record_channel,
+    replay_channel=args.replay_channel, metrics=args.metrics,
+    link_stats=args.link_stats, node_stats=args.node_stats,
+    rng=args.rng, payload=args.payload,
+    payload_size=args.payload_size,
+    payload_timestamps=args.payload_timestamps, precision=args.precision,
+    steady_metrics=args.steady_metric or STEADY_METRICS,
+    confidence=args.confidence, steady_warmup=args.steady_warmup)
+
+
+def new_partitioned_simulator(args):
+  from parallel import PartitionedSimulator
+
+  unsupported = [('--rng legacy', args.rng == 'legacy'),
+    ('--payload random', args.payload == 'random'), ('--trace', args.trace),
+    ('--record-channel', args.record_channel),
+    ('--replay-channel', args.replay_channel), ('--metrics', args.metrics),
+    ('--precision', args.precision), ('--resume', args.resume),
+    ('--snapshot', args.snapshot), ('--set', args.set),
+    ('--node-output-thread', args.node_output_thread)]
+
+  for option, given in unsupported:
+    if given:
+      raise RuntimeError('{} cannot be used with --partitions'.format(option))
+
+  with open(args.topology, 'r') as fin:
+    topology = json.load(fin)
+
+  return PartitionedSimulator(topology, args.partitions,
+    node_output=args.node_output, silent_nodes=args.silent_nodes,
+    stats_period=args.stats_period, stats_csv=args.stats_csv, seed=args.seed,
+    isolate_nodes=not args.shared_modules,
+    log_level=LogLevel[args.node_log_level.upper()],
+    link_stats=args.link_stats, node_stats=args.node_stats,
+    payload_size=args.payload_size,
+    payload_timestamps=args.payload_timestamps)
+
+
+def print_steady_state(counters, steady):
+  if steady.converged:
+    print('converged at {} usecs, warm-up {} usecs'.format(
+      counters['steady_converged_usec'], counters['steady_warmup_usec']))
+  else:
+    print('not converged by {} usecs, warm-up {} usecs'.format(
+      counters['time_usec'], counters['steady_warmup_usec']))
+
+  for metric in steady.metrics:
+    mean = counters[metric + '_mean']
+    if mean is None:
+      print('{}: no estimate'.format(metric))
+    else:
+      print('{}: {:.6g} +/- {:.3g} ({:g}% confidence)'.format(metric, mean,
+        counters[metric + '_halfwidth'], 100 * steady.confidence))
+
+if __name__ == '__main__':
+  # run through the importable module, so that snapshots refer to sim's
+  # classes rather than __main__'s and can be loaded by sweep.py too
+  import sim
+  sim.main()
@@ -0,0 +1,120 @@
+import importlib
+import os
+import pickle
+import struct
+import sys
+import types
+
+# Checkpoints of a whole simulator: nodes and their protocol objects, the
+# event queue, timers, transmit queues, random number generator states and
+# counters, pickled to one file so any number of runs can carry on from it.
+#
+# Protocol modules are the awkward part, as each node usually runs its own
+# copy of its module (see isolated_module_instance). A node module is saved
+# as its name plus its globals; loading executes the module's code afresh
+# and then puts the saved globals back. Functions and classes the module
+# defines are saved as references into it, so a Node object is restored as
+# an instance of its own node's copy of the class. Any other module is saved
+# by name and imported again.
+#
+# Open files (node output, traces and the stats CSV) are not saved; a loaded
+# simulator gets its own, see Simulator.from_snapshot().
+
+SNAPSHOT_MAGIC = b'NSSNAP01'
+
+# a snapshot is one deeply nested object graph
+RECURSION_LIMIT = 100000
+
+
+def restore_module(name, isolated):
+  from sim import isolated_module_instance
+
+  module = importlib.import_module(name)
+  if isolated:
+    module = isolated_module_instance(module, {})
+  return module
+
+
+def module_state(module):
+  return dict([(name, value) for name, value in vars(module).items()
+    if not (name.startswith('__') and name.endswith('__'))])
+
+
+def set_module_state(module, state):
+  vars(module).update(state)
+
+
+class SnapshotPickler(pickle.Pickler):
+  def __init__(self, file, node_modules):
+    pickle.Pickler.__init__(self, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    self.node_modules = {} # id(module) -> module, isolated
+    self.members = {} # id(function or class) -> (module, name)
+
+    for module, isolated in node_modules:
+      self.node_modules[id(module)] = (module, isolated)
+
+      for name, value in vars(module).items():
+        if isinstance(value, types.FunctionType) \
+            and value.__globals__ is vars(module):
+          self.members[id(value)] = (module, name)
+        elif isinstance(value, type) and value.__module__ == module.__name__:
+          self.members[id(value)] = (module, name)
+
+  def reducer_override(self, obj):
+    if isinstance(obj, types.ModuleType):
+      node_module = self.node_modules.get(id(obj))
+
+      if node_module is None:
+        return (importlib.import_module, (obj.__name__,))
+
+      module, isolated = node_module
+      return (restore_module, (module.__name__, isolated), module_state(module),
+        None, None, set_module_state)
+
+    if isinstance(obj, struct.Struct):
+      return (struct.Struct, (obj.format,))
+
+    member = self.members.get(id(obj))
+    if member is not None:
+      return (getattr, member)
+
+    return NotImplemented
+
+
+def save_snapshot(simulator, path, node_modules):
+  limit = sys.getrecursionlimit()
+  sys.setrecursionlimit(max(limit, RECURSION_LIMIT))
+
+  # written beside path and moved over it once complete, so an interrupted
+  # save never leaves a truncated snapshot where one is expected
+  partial = '{}.{}.tmp'.format(path, os.getpid())
+
+  try:
+    with open(partial, 'wb') as fout:
+      fout.write(SNAPSHOT_MAGIC)
+      SnapshotPickler(fout, node_modules).dump(simulator)
+    os.replace(partial, path)
+  except (pickle.PicklingError, TypeError, AttributeError) as e:
+    raise RuntimeError('cannot snapshot the simulation: {}'.format(e))
+  except OSError as e:
+    raise RuntimeError('cannot write snapshot {}: {}'.format(path, e))
+  finally:
+    sys.setrecursionlimit(limit)
+    if os.path.exists(partial):
+      os.remove(partial)
+
+
+def load_snapshot(path):
+  limit = sys.getrecursionlimit()
+  sys.setrecursionlimit(max(limit, RECURSION_LIMIT))
+
+  try:
+    with open(path, 'rb') as fin:
+      if fin.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+        raise RuntimeError('{} is not a simulator snapshot'.format(path))
+      return pickle.load(fin)
+  except (pickle.UnpicklingError, EOFError) as e:
+    raise RuntimeError('{} is a truncated or damaged snapshot: {}'.format(path, e))
+  finally:
+    sys.setrecursionlimit(limit)
@@ -0,0 +1,209 @@
+import math
+from statistics import NormalDist
+
+# Steady-state estimation by the method of batch means.
+#
+# Every stats period the monitor records how far the counters moved. Once
+# enough periods are in, the warm-up is cut off the front, either a fixed
+# time or, by default, where MSER-5 puts it: the series of messages
+# delivered per period is averaged in fives and truncated at the point that
+# minimises the squared standard error of what is left, looking no further
+# than half way. The remaining periods are grouped into `batches` equal
+# batches (dropping the oldest leftovers) and each metric is worked out per
+# batch. Consecutive periods are correlated, so a batch must span at least
+# min_batch_periods of them before there is any estimate: with one period per
+# batch the intervals would be far too narrow and runs would stop at the
+# first chance.
+#
+#   throughput     messages delivered per second
+#   delivery_time  mean delivery time in usecs (total delay / messages)
+#   efficiency     application bytes / physical bytes
+#
+# The confidence interval of a metric is the mean of its batch values plus
+# or minus t * s / sqrt(batches). The run has converged when every chosen
+# metric's half-width is within precision of its mean.
+
+METRICS = ('throughput', 'delivery_time', 'efficiency')
+
+DEFAULT_BATCHES = 20
+DEFAULT_MIN_BATCH_PERIODS = 5
+MSER_BLOCK = 5
+
+
+def t_quantile(p, df):
+  # Student's t quantile from the normal one (Cornish-Fisher expansion,
+  # good to a few parts in a thousand from 3 degrees of freedom up)
+  z = NormalDist().inv_cdf(p)
+  return (z + (z ** 3 + z) / (4 * df)
+    + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96 * df ** 2)
+    + (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / (384 * df ** 3))
+
+
+def mser_truncation(series, block=MSER_BLOCK):
+  # number of leading entries of series to discard
+  blocks = [sum(series[i:i + block]) / block
+    for i in range(0, len(series) - block + 1, block)]
+  n = len(blocks)
+
+  if n < 2:
+    return 0
+
+  # suffix sums, so the statistic for every truncation point is O(1)
+  total = 0.0
+  squares = 0.0
+  suffix = [None] * n
+  for j in range(n - 1, -1, -1):
+    total = total + blocks[j]
+    squares = squares + blocks[j] * blocks[j]
+    suffix[j] = (total, squares)
+
+  best = 0
+  best_value = None
+  for d in range(n // 2 + 1):
+    total, squares = suffix[d]
+    remaining = n - d
+    value = (squares - total * total / remaining) / (remaining * remaining)
+    if best_value is None or value < best_value:
+      best = d
+      best_value = value
+
+  return best * block
+
+
+class SteadyStateMonitor:
+  def __init__(self, precision, metrics=METRICS, confidence=0.95,
+      warmup_usec=None, batches=DEFAULT_BATCHES,
+      min_batch_periods=DEFAULT_MIN_BATCH_PERIODS):
+    for metric in metrics:
+      if not metric in METRICS:
+        raise RuntimeError('unknown steady state metric {}'.format(metric))
+
+    if not 0 < confidence < 1:
+      raise RuntimeError('confidence {} is not between 0 and 1'.format(confidence))
+
+    if batches < 2:
+      raise RuntimeError('batch means needs at least 2 batches')
+
+    if min_batch_periods < 1:
+      raise RuntimeError('a batch needs at least 1 stats period')
+
+    self.precision = precision
+    self.metrics = tuple(metrics)
+    self.confidence = confidence
+    self.warmup_usec = warmup_usec # None to find it with MSER-5
+    self.batches = batches
+    self.min_batch_periods = min_batch_periods
+    self.t = t_quantile((1 + confidence) / 2, batches - 1)
+
+    # per stats period: end time and the counter deltas
+    self.ends = []
+    self.lengths = []
+    self.delivered = []
+    self.delay = []
+    self.application = []
+    self.physical = []
+    self.last = (0, 0, 0, 0, 0)
+
+    self.truncated = 0 # periods discarded as warm-up
+    self.intervals = {} # metric -> (mean, half-width)
+    self.converged = False
+    self.converged_usec = None
+
+  def start(self, simulator):
+    # counters before this are not part of any period
+    self.last = self.counters(simulator)
+
+  def counters(self, simulator):
+    return (simulator.current_time_usec, simulator.messages_delivered,
+      simulator.total_delivery_time, simulator.bytes_received_application,
+      simulator.bytes_received_physical)
+
+  def record(self, simulator):
+    # called at the end of every stats period; returns True once converged
+    now = self.counters(simulator)
+
+    if now[0] == self.last[0]:
+      return self.converged
+
+    self.ends.append(now[0])
+    self.lengths.append(now[0] - self.last[0])
+    self.delivered.append(now[1] - self.last[1])
+    self.delay.append(now[2] - self.last[2])
+    self.application.append(now[3] - self.last[3])
+    self.physical.append(now[4] - self.last[4])
+    self.last = now
+
+    self.estimate()
+
+    if not self.converged and len(self.intervals) == len(self.metrics) \
+        and all([self.within_precision(metric) for metric in self.metrics]):
+      self.converged = True
+      self.converged_usec = now[0]
+
+    return self.converged
+
+  def within_precision(self, metric):
+    mean, half_width = self.intervals[metric]
+    return half_width <= self.precision * abs(mean) and mean != 0
+
+  def estimate(self):
+    n = len(self.ends)
+
+    if self.warmup_usec is not None:
+      self.truncated = 0
+      while self.truncated < n and self.ends[self.truncated] <= self.warmup_usec:
+        self.truncated = self.truncated + 1
+    else:
+      rates = [delivered / length for delivered, length
+        in zip(self.delivered, self.lengths)]
+      self.truncated = mser_truncation(rates)
+
+    size = (n - self.truncated) // self.batches
+    self.intervals = {}
+
+    if size < self.min_batch_periods:
+      return
+
+    start = n - size * self.batches
+    values = dict([(metric, []) for metric in self.metrics])
+
+    for b in range(start, n, size):
+      batch = slice(b, b + size)
+      batch_values = {
+        'throughput': (sum(self.delivered[batch]),
+          sum(self.lengths[batch]) / 1000000),
+        'delivery_time': (sum(self.delay[batch]), sum(self.delivered[batch])),
+        'efficiency': (sum(self.application[batch]), sum(self.physical[batch]))
+      }
+
+      for metric in self.metrics:
+        numerator, denominator = batch_values[metric]
+        if not denominator:
+          return # undefined in some batch, so no estimate yet
+        values[metric].append(numerator / denominator)
+
+    for metric in self.metrics:
+      batch_means = values[metric]
+      mean = sum(batch_means) / len(batch_means)
+      variance = sum([(x - mean) ** 2 for x in batch_means]) / (len(batch_means) - 1)
+      self.intervals[metric] = (mean, self.t * math.sqrt(variance / len(batch_means)))
+
+  def warmup_end(self):
+    # time the discarded warm-up ends
+    if self.truncated == 0:
+      return 0
+    return self.ends[self.truncated - 1]
+
+  def summary(self):
+    result = {
+      'steady_warmup_usec': self.warmup_end(),
+      'steady_converged': self.converged,
+      'steady_converged_usec': self.converged_usec
+    }
+
+    for metric in self.metrics:
+      mean, half_width = self.intervals.get(metric, (None, None))
+      result[metric + '_mean'] = mean
+      result[metric + '_halfwidth'] = half_width
+
+    return result
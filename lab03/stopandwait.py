@@ -1,7 +1,7 @@
 from enum import IntEnum
 import struct
 
-from defs import Event
+from defs import Event, LogLevel
 import checksums
 
 # This is an implementation of a stop-and-wait data link protocol with piggybacking.
@@ -44,6 +44,10 @@ def write_application(message):
     return True  # iff message accepted
 
 
+def log(level, message, *args):
+    pass  # message.format(*args) is only done if level is being output
+
+
 # Protocol-specific code
 
 class FrameType(IntEnum):
@@ -99,7 +103,7 @@ class Node:
             if self.ack_timer:
                 stop_timer(self.ack_timer)
                 self.ack_timer = None
-            print('{}Piggybacking ACK, seq={}'.format(self.printspaces, self.pending_ack_seq))
+            log(LogLevel.INFO, '{}Piggybacking ACK, seq={}', self.printspaces, self.pending_ack_seq)
         else:
             if kind == FrameType.DLL_ACK:
                 f.ack = seqno
@@ -114,9 +118,9 @@ class Node:
         write_physical(link, packed)
 
         if kind == FrameType.DLL_ACK:
-            print('{}ACK transmitted, seq={}'.format(self.printspaces, seqno))
+            log(LogLevel.INFO, '{}ACK transmitted, seq={}', self.printspaces, seqno)
         elif kind == FrameType.DLL_DATA:
-            print('{}DATA transmitted, seq={}'.format(self.printspaces, seqno))
+            log(LogLevel.INFO, '{}DATA transmitted, seq={}', self.printspaces, seqno)
 
             # Calculate timeout based on frame size and link properties
             timeout = (len(packed) * (8000000 // linkinfo[link].bandwidth)
@@ -128,7 +132,7 @@ class Node:
         self.lastmsg = message
         disable_application()
 
-        print('{}Down from application, seq={}'.format(self.printspaces, self.nextframetosend))
+        log(LogLevel.INFO, '{}Down from application, seq={}', self.printspaces, self.nextframetosend)
 
         self.transmit_frame(self.lastmsg, FrameType.DLL_DATA, self.nextframetosend)
         self.nextframetosend = 1 - self.nextframetosend
@@ -141,12 +145,12 @@ class Node:
         f.checksum = 0
 
         if (checksum != checksums.checksum_ccitt(f.pack())):
-            print('{}BAD checksum - frame ignored'.format(self.printspaces))
+            log(LogLevel.INFO, '{}BAD checksum - frame ignored', self.printspaces)
             return
 
         if f.kind == FrameType.DLL_DATA:
             if f.ack == self.ackexpected:
-                print('{}Received piggybacked ACK, seq={}'.format(self.printspaces, f.ack))
+                log(LogLevel.INFO, '{}Received piggybacked ACK, seq={}', self.printspaces, f.ack)
                 stop_timer(self.data_timer)
                 self.ackexpected = 1 - self.ackexpected
                 enable_application()
@@ -166,25 +170,25 @@ class Node:
             else:
                 result = 'ignored'
 
-            print('{}DATA received, seq={}, {}'.format(self.printspaces, f.seq, result))
+            log(LogLevel.INFO, '{}DATA received, seq={}, {}', self.printspaces, f.seq, result)
 
         # Process ACKs
         elif f.kind == FrameType.DLL_ACK:
             if f.ack == self.ackexpected:
-                print('{}ACK received, seq={}'.format(self.printspaces, f.ack))
+                log(LogLevel.INFO, '{}ACK received, seq={}', self.printspaces, f.ack)
                 stop_timer(self.data_timer)
                 self.ackexpected = 1 - self.ackexpected
                 enable_application()
 
     # frame transmission timeouts
     def data_timeout(self):
-        print('{}Data timeout, retransmitting seq={}'.format(self.printspaces, self.ackexpected))
+        log(LogLevel.INFO, '{}Data timeout, retransmitting seq={}', self.printspaces, self.ackexpected)
         self.transmit_frame(self.lastmsg, FrameType.DLL_DATA, self.ackexpected)
 
     # delayed ACK timeouts
     def ack_timeout(self, timerid):
         seq = timer_data(timerid)
-        print('{}ACK timeout, sending explicit ACK for seq={}'.format(self.printspaces, seq))
+        log(LogLevel.INFO, '{}ACK timeout, sending explicit ACK for seq={}', self.printspaces, seq)
         self.ack_pending = False
         self.transmit_frame(bytes(), FrameType.DLL_ACK, seq)
 
@@ -0,0 +1,271 @@
+import os
+import csv
+import json
+import argparse
+import itertools
+import multiprocessing
+
+import sim
+
+
+# Runs a grid of simulations across a process pool. Every cell of the grid
+# (topology x parameter values x replicate) is one run with its own seed, and
+# the final counters of each run become one row of the results table.
+#
+#   python sweep.py PIGGYBACK VARIATIONS -e 300s -r 5 -o results.csv \
+#     -p messagerate=500ms,1500ms -p probframecorrupt=2,3,4
+#
+# Each parameter is set on every link, or for messagerate on every node, of
+# the simulator built from the topology (see Simulator.set_parameter()), so
+# it overrides values given on individual hosts and links as well as at the
+# top level. If the results file already exists its completed runs are
+# skipped, so an interrupted sweep can be resumed by running the same command
+# again.
+#
+# With -w/--warmup DURATION each topology and replicate is first run for
+# DURATION once, and snapshotted (see snapshot.py) into a directory next to
+# the results file. Every parameter combination then carries on from that
+# snapshot to the execution duration, with the parameters set in the same way
+# after the warm-up. Runs forked from one snapshot share its seed.
+#
+# With --precision P each run stops as soon as the batch-means confidence
+# intervals of its throughput, delivery time and efficiency are within P of
+# their means (see steadystate.py), the execution duration becoming an upper
+# bound. The estimates, their half-widths, the warm-up that was discarded and
+# when the run converged are added to every row.
+
+STEADY_HEADER = ['Steady Warm-up (usec)', 'Converged (usec)']
+for metric in sim.STEADY_METRICS:
+  STEADY_HEADER = STEADY_HEADER + [metric + ' mean', metric + ' half-width']
+
+
+def parse_param(s):
+  if not '=' in s:
+    raise argparse.ArgumentTypeError('expected name=value[,value...], got {}'.format(s))
+
+  name, values = s.split('=', 1)
+  values = [v.strip() for v in values.split(',') if v.strip()]
+
+  if not values:
+    raise argparse.ArgumentTypeError('no values given for {}'.format(name))
+
+  return (name.strip(), values)
+
+
+def check_params(params):
+  # fail before any run for a parameter set_parameter() would reject
+  for name, values in params:
+    for value in values:
+      if name == 'messagerate':
+        sim.usecs_from_time(value, 'messagerate')
+      else:
+        sim.link_parameter(name, value)
+
+
+def build_jobs(topologies, params, replicates, base_seed, duration,
+    warmup=None, warmup_dir=None, precision=None):
+  names = [name for name, values in params]
+  jobs = []
+
+  for index, topology in enumerate(topologies):
+    for values in itertools.product(*[values for name, values in params]):
+      for replicate in range(replicates):
+        job = {
+          'topology': topology,
+          'params': dict(zip(names, values)),
+          'seed': base_seed + len(jobs),
+          'duration': duration,
+          'snapshot': None,
+          'precision': precision
+        }
+
+        if warmup:
+          job['seed'] = base_seed + index * replicates + replicate
+          job['warmup'] = warmup
+          job['snapshot'] = os.path.join(warmup_dir,
+            'warmup-{}.snap'.format(job['seed']))
+
+        jobs.append(job)
+
+  return jobs
+
+
+def job_key(job, names):
+  return tuple([job['topology']] + [job['params'][n] for n in names]
+    + [str(job['seed'])])
+
+
+def run_job(job):
+  with open(os.devnull, 'w') as devnull:
+    if job['snapshot']:
+      simulator = sim.Simulator.from_snapshot(job['snapshot'],
+        node_output=devnull, silent_nodes=True)
+
+      if job['precision']:
+        simulator.track_steady_state(job['precision'])
+    else:
+      with open(job['topology'], 'r') as fin:
+        topology = json.load(fin)
+
+      simulator = sim.Simulator(topology, node_output=devnull,
+        silent_nodes=True, seed=job['seed'], precision=job['precision'])
+
+    for name, value in job['params'].items():
+      simulator.set_parameter(name, value)
+
+    counters = simulator.run(job['duration'])
+    simulator.close()
+
+  return (job, counters)
+
+
+def run_warmup(job):
+  with open(job['topology'], 'r') as fin:
+    topology = json.load(fin)
+
+  with open(os.devnull, 'w') as devnull:
+    simulator = sim.Simulator(topology, node_output=devnull, silent_nodes=True,
+      seed=job['seed'])
+    simulator.run(job['warmup'])
+    simulator.snapshot(job['snapshot'])
+    simulator.close()
+
+  return job
+
+
+def drop_partial_row(path):
+  # an interrupted sweep may have left half a row at the end of the file
+  with open(path, 'rb+') as f:
+    data = f.read()
+    f.truncate(data.rfind(b'\n') + 1)
+
+
+def read_completed(path, names, precision=None):
+  completed = set()
+
+  if not os.path.exists(path):
+    return completed
+
+  drop_partial_row(path)
+
+  with open(path, 'r', newline='') as fin:
+    reader = csv.reader(fin)
+    header = next(reader, None)
+
+    if header is None:
+      return completed
+
+    if header != results_header(names, precision):
+      raise RuntimeError('{} was written by a sweep with different parameters'.format(path))
+
+    for row in reader:
+      if len(row) == len(header):
+        completed.add(tuple(row[:len(names) + 2]))
+
+  return completed
+
+
+def results_header(names, precision=None):
+  header = ['Topology'] + names + ['Seed'] + sim.STATS_CSV_HEADER
+  if precision:
+    header = header + STEADY_HEADER
+  return header
+
+
+def results_row(job, names, counters):
+  row = [job['topology']] + [job['params'][n] for n in names] + [job['seed'],
+    counters['time_usec'],
+    counters['events_raised'],
+    counters['messages_generated'], counters['messages_delivered'],
+    counters['average_delivery_time'],
+    counters['frames_transmitted'], counters['frames_received'],
+    counters['bytes_received_physical'],
+    counters['bytes_received_application'],
+    counters['efficiency']]
+
+  if job['precision']:
+    row = row + [counters['steady_warmup_usec'],
+      counters['steady_converged_usec']]
+    for metric in sim.STEADY_METRICS:
+      row = row + [counters[metric + '_mean'], counters[metric + '_halfwidth']]
+
+  return row
+
+
+def sweep(topologies, params, output, replicates=1, base_seed=1,
+    duration=None, processes=None, warmup=None, precision=None):
+  check_params(params)
+
+  names = [name for name, values in params]
+  warmup_dir = output + '.warmup'
+  jobs = build_jobs(topologies, params, replicates, base_seed, duration,
+    warmup, warmup_dir, precision)
+
+  completed = read_completed(output, names, precision)
+  pending = [job for job in jobs if not job_key(job, names) in completed]
+
+  print('{} runs, {} already done, {} to go'.format(len(jobs),
+    len(jobs) - len(pending), len(pending)))
+
+  if not pending:
+    return
+
+  with open(output, 'a+', newline='') as fout:
+    writer = csv.writer(fout, quoting=csv.QUOTE_MINIMAL)
+
+    if fout.tell() == 0:
+      writer.writerow(results_header(names, precision))
+
+    with multiprocessing.Pool(processes) as pool:
+      if warmup:
+        warm_ups = dict([(job['snapshot'], job) for job in pending
+          if not os.path.exists(job['snapshot'])])
+        os.makedirs(warmup_dir, exist_ok=True)
+
+        for job in pool.imap_unordered(run_warmup, warm_ups.values()):
+          print('warmed up {} seed={}'.format(job['topology'], job['seed']))
+
+      done = 0
+      for job, counters in pool.imap_unordered(run_job, pending):
+        writer.writerow(results_row(job, names, counters))
+        fout.flush() # rows on disk are what a resumed sweep skips
+        done = done + 1
+        print('[{}/{}] {} {} seed={}'.format(done, len(pending),
+          job['topology'], job['params'], job['seed']))
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog='Network Simulator Sweep')
+
+  parser.add_argument('topology', nargs='+')
+
+  parser.add_argument('-p', '--param', action='append', type=parse_param,
+    default=[])
+
+  parser.add_argument('-r', '--replicates', type=int, default=1)
+
+  parser.add_argument('-S', '--seed', type=int, default=1)
+
+  parser.add_argument('-e', '--execution-duration', required=True)
+
+  parser.add_argument('-j', '--processes', type=int,
+    default=os.cpu_count())
+
+  parser.add_argument('-o', '--output', required=True)
+
+  parser.add_argument('-w', '--warmup')
+
+  parser.add_argument('--precision', type=float)
+
+  args = parser.parse_args(argv)
+
+  try:
+    sweep(args.topology, args.param, args.output, args.replicates, args.seed,
+      args.execution_duration, args.processes, args.warmup, args.precision)
+  except RuntimeError as e:
+    print(e)
+    exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,109 @@
+import heapq
+
+# Node timers, kept as entries of the simulator's event queue.
+#
+# Every timer has one queue entry, pushed when it is started, and the
+# TimerTable maps each live timer's id to its Timer record. Stopping a timer
+# only marks the record as cancelled; its entry is skipped when it reaches
+# the head of the queue. Cancelled entries are counted, and once they are
+# more than half of the queue compact() removes them all in one pass, so a
+# protocol that stops nearly every timer it starts (as stop-and-wait does on
+# each acknowledgement) cannot fill the queue with dead entries.
+#
+# Records are released back to the table once their entry has left the
+# queue, and reused by later start() calls.
+
+# queues shorter than this are never compacted
+COMPACT_MIN_ENTRIES = 64
+
+
+class Timer:
+  __slots__ = ('timeout', 'timerid', 'nodenumber', 'event', 'data',
+    'cancelled')
+
+  def __init__(self, timeout, timerid, nodenumber, event, data):
+    self.timeout = timeout
+    self.timerid = timerid
+    self.nodenumber = nodenumber
+    self.event = event
+    self.data = data
+    self.cancelled = False
+
+
+class TimerTable:
+  def __init__(self):
+    self.timers = {} # lookup from timerID to every live timer
+    self.free = [] # released Timer records
+    self.cancelled_queued = 0 # entries of cancelled timers still queued
+
+    self.timers_started = 0
+    self.timers_cancelled = 0
+    self.timers_expired = 0
+
+  def __len__(self):
+    return len(self.timers)
+
+  def __contains__(self, timerid):
+    return timerid in self.timers
+
+  def get(self, timerid):
+    return self.timers.get(timerid)
+
+  def start(self, timeout, timerid, nodenumber, event, data):
+    # the caller queues the returned Timer
+    if self.free:
+      timer = self.free.pop()
+      timer.timeout = timeout
+      timer.timerid = timerid
+      timer.nodenumber = nodenumber
+      timer.event = event
+      timer.data = data
+      timer.cancelled = False
+    else:
+      timer = Timer(timeout, timerid, nodenumber, event, data)
+
+    self.timers[timerid] = timer
+    self.timers_started = self.timers_started + 1
+    return timer
+
+  def cancel(self, timerid):
+    timer = self.timers.pop(timerid, None)
+
+    if timer is None:
+      return False
+
+    timer.cancelled = True
+    timer.data = None
+    self.timers_cancelled = self.timers_cancelled + 1
+    self.cancelled_queued = self.cancelled_queued + 1
+    return True
+
+  def finished(self, timer):
+    # after the handler of a timer that was not cancelled has run
+    if self.timers.pop(timer.timerid, None) is not None:
+      self.timers_expired = self.timers_expired + 1
+
+  def release(self, timer):
+    # once the timer's entry has left the queue
+    if timer.cancelled:
+      self.cancelled_queued = self.cancelled_queued - 1
+    timer.data = None
+    self.free.append(timer)
+
+  def needs_compacting(self, queue):
+    return self.cancelled_queued * 2 > len(queue) \
+      and len(queue) >= COMPACT_MIN_ENTRIES
+
+  def compact(self, queue, kind):
+    # drops the entries of cancelled timers from queue, a heap whose timer
+    # entries have kind at index 4 and their Timer at index 5; the heap is
+    # changed in place, as other code may hold it
+    live = []
+    for entry in queue:
+      if entry[4] == kind and entry[5].cancelled:
+        self.release(entry[5])
+      else:
+        live.append(entry)
+
+    queue[:] = live
+    heapq.heapify(queue)
@@ -0,0 +1,273 @@
+import sys
+import math
+import json
+import random
+import argparse
+
+from topology import bps_from_bandwidth, usecs_from_time
+
+# Synthetic topologies for finding where the simulator stops scaling.
+#
+#   python topogen.py ring -n 500 -d 4 -o ring500.json \
+#     --bandwidth uniform:56Kbps,10Mbps --propagationdelay choice:5ms,50ms
+#
+# or, without files, from Python:
+#
+#   topology = topogen.generate('grid', 2500, bandwidth='1Mbps', seed=3)
+#
+# Shapes, for n nodes named node0 ... and a degree d:
+#
+#   ring    every node linked to its d // 2 nearest neighbours each way (d 2)
+#   line    node i linked to node i + 1
+#   star    node0 linked to every other node
+#   grid    rows as wide as the square root of n, each node linked to the
+#           nodes to its right and below
+#   tree    every node but node0 linked to its parent, d children each (d 2)
+#   random  a random spanning tree with links added at random until the mean
+#           degree is d (d 4), so always connected
+#
+# bandwidth, propagationdelay and probframeloss each take a value as a
+# topology file gives it (e.g. "1Mbps", "10ms", 3), which is set once at the
+# top level, or a distribution drawn from once per link:
+#
+#   uniform:LOW,HIGH    a whole number of bps, usecs or, for probframeloss,
+#                       a power of two between LOW and HIGH inclusive
+#   choice:A,B,...      one of the values, equally likely
+#
+# A drawn value applies to both directions of its link, so such links are
+# listed by both of their hosts. The same seed gives the same topology.
+
+SHAPES = ('ring', 'line', 'star', 'grid', 'tree', 'random')
+
+DEFAULT_DEGREE = {'ring': 2, 'tree': 2, 'random': 4}
+
+DISTRIBUTED_KEYS = ('bandwidth', 'propagationdelay', 'probframeloss')
+
+
+def probframeloss_value(value, what='probframeloss'):
+  try:
+    return int(value)
+  except (TypeError, ValueError):
+    raise RuntimeError('failed to set {}={}'.format(what, value))
+
+
+VALUE_PARSERS = {
+  'bandwidth': bps_from_bandwidth,
+  'propagationdelay': usecs_from_time,
+  'probframeloss': probframeloss_value
+}
+
+
+class Distribution:
+  # kind is 'constant', 'uniform' or 'choice'; values are as given, and
+  # bounds the uniform ones parsed into numbers
+  def __init__(self, name, kind, values):
+    if not name in VALUE_PARSERS:
+      raise RuntimeError('cannot generate values of {}'.format(name))
+
+    parse = VALUE_PARSERS[name]
+    parsed = [parse(value, name) for value in values]
+
+    if kind == 'constant' or kind == 'choice':
+      if not values or (kind == 'constant' and len(values) != 1):
+        raise RuntimeError('{} {} needs {} value'.format(name, kind,
+          'one' if kind == 'constant' else 'at least one'))
+    elif kind == 'uniform':
+      if len(parsed) != 2 or parsed[0] > parsed[1]:
+        raise RuntimeError('{} uniform needs LOW,HIGH with LOW <= HIGH'.format(name))
+    else:
+      raise RuntimeError('unknown distribution {} for {}'.format(kind, name))
+
+    self.name = name
+    self.kind = kind
+    self.values = list(values)
+    self.bounds = parsed
+
+  def constant(self):
+    return self.kind == 'constant'
+
+  def draw(self, rng):
+    if self.kind == 'uniform':
+      return rng.randint(self.bounds[0], self.bounds[1])
+    if self.kind == 'choice':
+      return self.values[rng.randrange(len(self.values))]
+    return self.values[0]
+
+
+def distribution(name, spec):
+  # a Distribution from a value, a 'kind:values' string or a Distribution
+  if isinstance(spec, Distribution):
+    return spec
+
+  if isinstance(spec, str) and ':' in spec:
+    kind, values = spec.split(':', 1)
+    values = [v.strip() for v in values.split(',') if v.strip()]
+    if name == 'probframeloss':
+      values = [probframeloss_value(v) for v in values]
+    return Distribution(name, kind.strip(), values)
+
+  if name == 'probframeloss':
+    spec = probframeloss_value(spec)
+
+  return Distribution(name, 'constant', [spec])
+
+
+def ring_edges(nodes, degree, rng):
+  edges = {}
+  for i in range(nodes):
+    for step in range(1, max(1, degree // 2) + 1):
+      j = (i + step) % nodes
+      if j != i:
+        edges[(min(i, j), max(i, j))] = True
+  return list(edges)
+
+
+def line_edges(nodes, degree, rng):
+  return [(i, i + 1) for i in range(nodes - 1)]
+
+
+def star_edges(nodes, degree, rng):
+  return [(0, i) for i in range(1, nodes)]
+
+
+def grid_edges(nodes, degree, rng):
+  width = math.isqrt(nodes)
+  if width * width < nodes:
+    width = width + 1
+
+  edges = []
+  for i in range(nodes):
+    if (i + 1) % width and i + 1 < nodes:
+      edges.append((i, i + 1))
+    if i + width < nodes:
+      edges.append((i, i + width))
+  return edges
+
+
+def tree_edges(nodes, degree, rng):
+  return [((i - 1) // degree, i) for i in range(1, nodes)]
+
+
+def random_edges(nodes, degree, rng):
+  edges = {}
+  for i in range(1, nodes):
+    edges[(rng.randrange(i), i)] = True
+
+  wanted = min(nodes * degree // 2, nodes * (nodes - 1) // 2)
+  while len(edges) < wanted:
+    i = rng.randrange(nodes)
+    j = rng.randrange(nodes)
+    if i != j:
+      edges[(min(i, j), max(i, j))] = True
+  return list(edges)
+
+
+EDGE_BUILDERS = {
+  'ring': ring_edges,
+  'line': line_edges,
+  'star': star_edges,
+  'grid': grid_edges,
+  'tree': tree_edges,
+  'random': random_edges
+}
+
+
+def generate(shape, nodes, degree=None, seed=None, bandwidth=None,
+    propagationdelay=None, probframeloss=None, messagerate=None, module=None):
+  # a topology, as json.load() would return it, of nodes hosts
+  if not shape in EDGE_BUILDERS:
+    raise RuntimeError('unknown shape {}, expected one of {}'.format(shape,
+      ', '.join(SHAPES)))
+
+  if nodes < 1:
+    raise RuntimeError('a topology needs at least one node')
+
+  if degree is None:
+    degree = DEFAULT_DEGREE.get(shape, 1)
+  if degree < 1:
+    raise RuntimeError('degree {} is less than 1'.format(degree))
+
+  rng = random.Random(seed)
+  edges = EDGE_BUILDERS[shape](nodes, degree, rng)
+
+  distributions = []
+  for name, spec in zip(DISTRIBUTED_KEYS,
+      (bandwidth, propagationdelay, probframeloss)):
+    if spec is not None:
+      distributions.append(distribution(name, spec))
+
+  topology = {}
+  if module is not None:
+    topology['module'] = module
+  if messagerate is not None:
+    topology['messagerate'] = messagerate
+
+  drawn = []
+  for d in distributions:
+    if d.constant():
+      topology[d.name] = d.draw(rng)
+    else:
+      drawn.append(d)
+
+  names = ['node{}'.format(i) for i in range(nodes)]
+  hosts = [{'name': name, 'links': []} for name in names]
+
+  for a, b in edges:
+    link = {'to': names[b]}
+    hosts[a]['links'].append(link)
+
+    if drawn:
+      for d in drawn:
+        link[d.name] = d.draw(rng)
+      back = dict(link)
+      back['to'] = names[a]
+      hosts[b]['links'].append(back)
+
+  topology['hosts'] = hosts
+  return topology
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog='Network Topology Generator')
+
+  parser.add_argument('shape', choices=SHAPES)
+
+  parser.add_argument('-n', '--nodes', type=int, required=True)
+
+  parser.add_argument('-d', '--degree', type=int)
+
+  parser.add_argument('-S', '--seed', type=int, default=1)
+
+  parser.add_argument('-b', '--bandwidth')
+
+  parser.add_argument('-p', '--propagationdelay')
+
+  parser.add_argument('-l', '--probframeloss')
+
+  parser.add_argument('-m', '--messagerate')
+
+  parser.add_argument('--module')
+
+  parser.add_argument('-o', '--output')
+
+  args = parser.parse_args(argv)
+
+  try:
+    topology = generate(args.shape, args.nodes, args.degree, args.seed,
+      args.bandwidth, args.propagationdelay, args.probframeloss,
+      args.messagerate, args.module)
+  except RuntimeError as e:
+    print(e)
+    exit(1)
+
+  if args.output is None:
+    json.dump(topology, sys.stdout, indent=2)
+    print()
+  else:
+    with open(args.output, 'w') as fout:
+      json.dump(topology, fout, indent=2)
+      fout.write('\n')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,359 @@
+import re
+
+from defs import LinkType, LinkInfo, QueuePolicy
+from channels import CHANNEL_KEYS
+
+# Topologies, from the JSON a user writes to what the simulator builds.
+#
+# compile_topology() checks the parsed JSON and returns a Topology with
+# every unit string already turned into numbers:
+#
+#   hosts  (name, hostinfo, messagerate) for each host, in order; unnamed
+#          hosts are called 'Host n' (counting from 1)
+#   links  (a, b, forward, backward) for each undirected link, in the order
+#          links first appear; a and b are host indexes and forward and
+#          backward the LinkParams of the directions a to b and b to a
+#
+# A link may be listed by either host or by both. Keys given on a host's
+# link apply to the direction leaving that host; everything else comes from
+# the top level of the topology. Directions without keys of their own share
+# one LinkParams, and strings such as "56Kbps" are parsed once however many
+# links give them, so large topologies compile in time linear in their size.
+#
+# Anything the simulator could not build raises a RuntimeError: unknown or
+# duplicate hosts, links to nowhere or to their own host, and a direction
+# given twice.
+
+TIME_SUFFIX_TO_USEC = {
+  'us':                1,
+  'ms':             1000,
+  's':           1000000,
+  'm':      60 * 1000000,
+  'h': 60 * 60 * 1000000
+}
+
+BANDWIDTH_SUFFIX_TO_BITS_PER_SEC = {
+   'bps': 1,
+  'Kbps': 1<<10,
+  'Mbps': 1<<20,
+  'Gbps': 1<<30
+}
+
+# the power of two key of each probability a channel model takes
+PROBABILITY_KEYS = (('probframeloss', 'lossprob'),
+  ('probframecorrupt', 'corruptprob'))
+
+# the CHANNEL_KEYS that are plain probabilities
+CHANNEL_PROBABILITIES = ('lossprob', 'corruptprob', 'biterrorrate')
+
+DEFAULT_BANDWIDTH = 56 * 1024
+DEFAULT_PROPAGATION_DELAY = 2500 * 1000
+DEFAULT_MESSAGE_RATE = TIME_SUFFIX_TO_USEC['s']
+
+
+def usecs_from_time_str(s):
+  s = s.strip()
+
+  match = re.match(r'(\d+)\s*(.*)', s)
+
+  if match:
+    digits, suffix = match.group(1, 2)
+
+    digits = int(digits)
+
+    if suffix:
+      if suffix in TIME_SUFFIX_TO_USEC:
+        digits = digits * TIME_SUFFIX_TO_USEC[suffix]
+      else:
+        raise RuntimeError('unknown time suffix {}'.format(suffix))
+
+    return digits
+
+  raise RuntimeError('invalid time string {}'.format(s))
+
+
+def bps_from_bandwidth_str(s):
+  s = s.strip()
+
+  match = re.match(r'(\d+)\s*(.*)', s)
+
+  if match:
+    digits, suffix = match.group(1, 2)
+
+    digits = int(digits)
+
+    if suffix:
+      if suffix in BANDWIDTH_SUFFIX_TO_BITS_PER_SEC:
+        digits = digits * BANDWIDTH_SUFFIX_TO_BITS_PER_SEC[suffix]
+      else:
+        raise RuntimeError('unknown bandwidth suffix {}'.format(suffix))
+
+    return digits
+
+  raise RuntimeError('invalid bandwidth string {}'.format(s))
+
+
+def usecs_from_time(value, what='time'):
+  # accepts either a number of usecs or a time string such as '1500ms'
+  if value is None or isinstance(value, int):
+    return value
+
+  try:
+    return usecs_from_time_str(value)
+  except RuntimeError:
+    raise RuntimeError('failed to set {}={}'.format(what, value))
+
+
+def bps_from_bandwidth(value, what='bandwidth'):
+  if value is None or isinstance(value, int):
+    return value
+
+  try:
+    return bps_from_bandwidth_str(value)
+  except RuntimeError:
+    raise RuntimeError('failed to set {}={}'.format(what, value))
+
+
+def queue_policy(value, what='txqueuepolicy'):
+  try:
+    return QueuePolicy[value.upper()]
+  except (KeyError, AttributeError):
+    raise RuntimeError('failed to set {}={}'.format(what, value))
+
+
+def link_parameter(name, value):
+  # a LinkInfo attribute, or a probability a channel model takes, parsed from
+  # the way topologies give it
+  if name == 'bandwidth':
+    return bps_from_bandwidth(value)
+
+  if name == 'propagationdelay':
+    return usecs_from_time(value, 'propagationdelay')
+
+  try:
+    if name in ('probframeloss', 'probframecorrupt'):
+      return 1 << int(value)
+
+    if name == 'txqueuelength':
+      return None if value is None or value == 'none' else int(value)
+
+    if name in CHANNEL_PROBABILITIES:
+      probability = float(value)
+      if not 0.0 <= probability <= 1.0:
+        raise ValueError(value)
+      return probability
+  except (TypeError, ValueError):
+    raise RuntimeError('failed to set {}={}'.format(name, value))
+
+  if name == 'txqueuepolicy':
+    return queue_policy(value)
+
+  if name == 'linkup':
+    return value in (True, 1, '1', 'true', 'up')
+
+  raise RuntimeError('cannot set link parameter {}'.format(name))
+
+
+def fold_probabilities(channel, params):
+  # the power of two keys of params (LinkParams or LinkInfo) still apply
+  # where no probability in the channel keys replaces them
+  if channel and not 'channel' in channel:
+    for name, key in PROBABILITY_KEYS:
+      value = getattr(params, name)
+      if value:
+        channel.setdefault(key, 1 / value)
+
+
+class LinkParams:
+  # the settings of one direction of a link
+  __slots__ = ('bandwidth', 'propagationdelay', 'probframeloss',
+    'probframecorrupt', 'txqueuelength', 'txqueuepolicy', 'channel')
+
+  def __init__(self, bandwidth, propagationdelay, probframeloss,
+      probframecorrupt, txqueuelength, txqueuepolicy, channel):
+    self.bandwidth = bandwidth
+    self.propagationdelay = propagationdelay
+    self.probframeloss = probframeloss
+    self.probframecorrupt = probframecorrupt
+    self.txqueuelength = txqueuelength
+    self.txqueuepolicy = txqueuepolicy
+    self.channel = channel # CHANNEL_KEYS for build_channel()
+
+  def copy(self):
+    return LinkParams(self.bandwidth, self.propagationdelay, self.probframeloss,
+      self.probframecorrupt, self.txqueuelength, self.txqueuepolicy,
+      self.channel)
+
+  def linkinfo(self):
+    return LinkInfo(LinkType.WAN, self.bandwidth, self.propagationdelay,
+      self.probframeloss, self.probframecorrupt, self.txqueuelength,
+      self.txqueuepolicy)
+
+  def fold_probabilities(self):
+    fold_probabilities(self.channel, self)
+
+
+class Topology:
+  def __init__(self, messagerate, defaults):
+    self.messagerate = messagerate
+    self.defaults = defaults # LinkParams of directions with no keys of their own
+    self.hosts = []
+    self.links = []
+    self.host_index = {} # name -> index into hosts
+
+  def neighbours(self):
+    # for each host, the indexes of the hosts it has links to
+    result = [[] for host in self.hosts]
+    for a, b, forward, backward in self.links:
+      result[a].append(b)
+      result[b].append(a)
+    return result
+
+
+class TopologyCompiler:
+  def __init__(self):
+    self.parsed = {} # (name, string) -> value, so each string is parsed once
+    self.channel = {} # CHANNEL_KEYS at the top level, before any folding
+
+  def parameter(self, name, value):
+    if not isinstance(value, str):
+      return link_parameter(name, value)
+
+    key = (name, value)
+    if not key in self.parsed:
+      self.parsed[key] = link_parameter(name, value)
+    return self.parsed[key]
+
+  def messagerate(self, value):
+    key = ('messagerate', value)
+    if not key in self.parsed:
+      self.parsed[key] = usecs_from_time(value, 'messagerate')
+    return self.parsed[key]
+
+  def defaults(self, topology):
+    params = LinkParams(DEFAULT_BANDWIDTH, DEFAULT_PROPAGATION_DELAY, 0, 0,
+      None, QueuePolicy.DROPTAIL, {})
+
+    for name in ('probframeloss', 'probframecorrupt'):
+      if name in topology:
+        setattr(params, name, self.parameter(name, topology[name]))
+
+    for name in ('bandwidth', 'propagationdelay', 'txqueuepolicy'):
+      if topology.get(name):
+        setattr(params, name, self.parameter(name, topology[name]))
+
+    if topology.get('txqueuelength') is not None:
+      params.txqueuelength = self.parameter('txqueuelength',
+        topology['txqueuelength'])
+
+    self.channel = dict([(key, topology[key]) for key in CHANNEL_KEYS
+      if key in topology])
+    params.channel = dict(self.channel)
+    params.fold_probabilities()
+    return params
+
+  def direction(self, defaults, link):
+    # the LinkParams of the direction a host's link entry describes
+    if len(link) == 1:
+      return defaults # just 'to'
+
+    params = defaults.copy()
+
+    for name in ('bandwidth', 'propagationdelay', 'txqueuepolicy'):
+      if link.get(name):
+        setattr(params, name, self.parameter(name, link[name]))
+
+    for name in ('probframeloss', 'probframecorrupt', 'txqueuelength'):
+      if name in link:
+        setattr(params, name, self.parameter(name, link[name]))
+
+    # folded again, as this direction's probabilities may differ
+    params.channel = dict(self.channel)
+    for key in CHANNEL_KEYS:
+      if key in link:
+        params.channel[key] = link[key]
+
+    # a power of two key given on the link beats a probability inherited
+    # from the top level
+    for name, key in PROBABILITY_KEYS:
+      if name in link and not key in link:
+        params.channel.pop(key, None)
+
+    params.fold_probabilities()
+    return params
+
+  def compile(self, topology):
+    if not isinstance(topology, dict):
+      raise RuntimeError('a topology must be a JSON object')
+
+    messagerate = DEFAULT_MESSAGE_RATE
+    if topology.get('messagerate'):
+      messagerate = self.messagerate(topology['messagerate'])
+
+    defaults = self.defaults(topology)
+    result = Topology(messagerate, defaults)
+
+    hosts = topology.get('hosts', [])
+    if not isinstance(hosts, list):
+      raise RuntimeError('the hosts of a topology must be a list')
+
+    for hostnum, host in enumerate(hosts, 1):
+      if not isinstance(host, dict):
+        raise RuntimeError('host {} is not a JSON object'.format(hostnum))
+
+      name = host.get('name', 'Host {}'.format(hostnum))
+      if not isinstance(name, str):
+        raise RuntimeError('the name of host {} is not a string'.format(hostnum))
+      if name in result.host_index:
+        raise RuntimeError('more than one host is called {}'.format(name))
+
+      rate = messagerate
+      if host.get('messagerate'):
+        rate = self.messagerate(host['messagerate'])
+
+      result.host_index[name] = len(result.hosts)
+      result.hosts.append((name, host, rate))
+
+    pairs = {} # (lower index, higher index) -> index into result.links
+    given = set() # (from, to) of every direction a host has described
+
+    for a, host in enumerate(hosts):
+      links = host.get('links', [])
+      if not isinstance(links, list):
+        raise RuntimeError('the links of {} must be a list'.format(
+          result.hosts[a][0]))
+
+      for link in links:
+        name = result.hosts[a][0]
+
+        if not isinstance(link, dict) or not 'to' in link:
+          raise RuntimeError('a link of {} has no "to"'.format(name))
+
+        b = result.host_index.get(link['to'])
+        if b is None:
+          raise RuntimeError('{} has a link to unknown node {}'.format(
+            name, link['to']))
+        if b == a:
+          raise RuntimeError('{} has a link to itself'.format(name))
+        if (a, b) in given:
+          raise RuntimeError('{} gives its link to {} more than once'.format(
+            name, link['to']))
+        given.add((a, b))
+
+        params = self.direction(defaults, link)
+        pair = (a, b) if a < b else (b, a)
+        index = pairs.get(pair)
+
+        if index is None:
+          pairs[pair] = len(result.links)
+          result.links.append((a, b, params, defaults))
+        else:
+          # the other host listed it first, so this is its backward direction
+          first, second, forward, backward = result.links[index]
+          result.links[index] = (first, second, forward, params)
+
+    return result
+
+
+def compile_topology(topology):
+  return TopologyCompiler().compile(topology)